@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+# Offline benchmarks for detection, kmod selection and CLI startup
+#
+# Results are written as JSON, pass an earlier result via --compare to fail on regressions:
+#   ./bench.py --output bench_output.txt
+#   ./bench.py --compare bench_output.txt --max-regression 1.0
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from lbdist.distribution import Distribution, LinbitDistribution
+from lbdist.kmod import KmodCandidates, KmodIndex, write_kmod_index
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# one root file system per supported ID, path -> content
+FIXTURES = {
+    'amzn': {'etc/os-release': 'NAME="Amazon Linux"\nID="amzn"\nID_LIKE="centos rhel fedora"\nVERSION_ID="2"\n'},
+    'centos': {'etc/os-release': 'NAME="CentOS Linux"\nID="centos"\nID_LIKE="rhel fedora"\nVERSION_ID="7"\n',
+               'etc/centos-release': 'CentOS Linux release 7.9.2009 (Core)\n'},
+    'rhel': {'etc/os-release': 'NAME="Red Hat Enterprise Linux"\nID="rhel"\nID_LIKE="fedora"\nVERSION_ID="8.6"\n'},
+    'rhcos': {'etc/os-release': 'NAME="Red Hat Enterprise Linux CoreOS"\nID="rhcos"\nID_LIKE="rhel fedora"\n'
+                                'VERSION_ID="4.10"\nRHEL_VERSION="8.4"\n'},
+    'almalinux': {'etc/os-release': 'NAME="AlmaLinux"\nID="almalinux"\nID_LIKE="rhel centos fedora"\n'
+                                    'VERSION_ID="9.1"\n'},
+    'rocky': {'etc/os-release': 'NAME="Rocky Linux"\nID="rocky"\nID_LIKE="rhel centos fedora"\nVERSION_ID="8.7"\n'},
+    'debian': {'etc/os-release': 'NAME="Debian GNU/Linux"\nID=debian\nVERSION_ID="11"\nVERSION="11 (bullseye)"\n'},
+    'ubuntu': {'etc/os-release': 'NAME="Ubuntu"\nID=ubuntu\nID_LIKE=debian\nVERSION_ID="22.04"\n'
+                                 'VERSION_CODENAME=jammy\n'},
+    'xenenterprise': {'etc/os-release': 'NAME="XenServer"\nID="xenenterprise"\nID_LIKE="centos rhel fedora"\n'
+                                        'VERSION_ID="8.2.1"\n'},
+    'ol': {'etc/os-release': 'NAME="Oracle Linux Server"\nID="ol"\nID_LIKE="fedora"\nVERSION_ID="8.7"\n'},
+    'sles': {'etc/os-release': 'NAME="SLES"\nID="sles"\nID_LIKE="suse"\nVERSION_ID="15.4"\n'},
+    'opensuse-leap': {'etc/os-release': 'NAME="openSUSE Leap"\nID="opensuse-leap"\nID_LIKE="suse opensuse"\n'
+                                        'VERSION_ID="15.4"\n'},
+    'proxmox': {'etc/os-release': 'NAME="Debian GNU/Linux"\nID=debian\nVERSION_ID="11"\nVERSION="11 (bullseye)"\n',
+                'usr/bin/pveversion': '#!/bin/sh\necho pve-manager/7.2-5/12f1e639\n',
+                'var/lib/dpkg/status': 'Package: pve-firewall\nStatus: install ok installed\nVersion: 4.2-5\n\n'
+                                       'Package: pve-manager\nStatus: install ok installed\nVersion: 7.2-5\n\n'},
+}
+
+
+# highest resolution clock available (time.perf_counter is Python 3 only)
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def measure(fn, repeat=7, batch_time=0.05):
+    # time per call of fn, timeit style: fn runs in batches that are grown (1, 2, 5, 10, 20, ... calls)
+    # until one takes batch_time, so timer resolution and per call jitter average out, then repeat batches
+    # are timed and the median counts (the fastest one is just as much an outlier as the slowest)
+    # returns (seconds per call, total number of calls)
+    def batch(number):
+        t = _timer()
+        for _ in range(number):
+            fn()
+        return _timer() - t
+
+    calls = 0
+    i = 0
+    while True:
+        n = (1, 2, 5)[i % 3] * 10 ** (i // 3)
+        t = batch(n)
+        calls += n
+        if t >= batch_time:
+            break
+        i += 1
+
+    times = [t / n]
+    for _ in range(repeat - 1):
+        times.append(batch(n) / n)
+        calls += n
+    times.sort()
+    return times[len(times) // 2], calls
+
+
+def synthetic_kmods(n, seed=0):
+    # mix of RHEL and SLES style kmod packages for a few kernels, plus some noise
+    rnd = random.Random(seed)
+    kmods = []
+    for i in range(n):
+        r = rnd.random()
+        if r < 0.45:
+            kernel = rnd.choice(('3.10.0', '4.18.0', '5.14.0'))
+            kmods.append('rhel/kmod-drbd-9.1.{0}_{1}_{2}.{3}.el8-1.x86_64.rpm'.format(
+                rnd.randint(0, 20), kernel, rnd.randint(1, 600), rnd.randint(0, 30)))
+        elif r < 0.9:
+            kernel = rnd.choice(('4.12.14', '5.3.18', '5.14.21'))
+            kmods.append('sles15-sp{0}/drbd-kmp-default-9.1.{1}_k{2}_{3}.{4}-1.x86_64.rpm'.format(
+                rnd.randint(0, 5), rnd.randint(0, 20), kernel, rnd.randint(1, 200), rnd.randint(0, 60)))
+        else:
+            kmods.append('rhel/drbd-utils-9.{0}.0-1.x86_64.rpm'.format(i))
+    return kmods
+
+
+KMOD_QUERIES = (('rhel8.6', '4.18.0-372.9.1.el8.x86_64'), ('sles15-sp4', '5.14.21-150400.24.46-default'))
+
+
+def bench_kmods(sizes, tmpdir):
+    results = []
+    for n in sizes:
+        kmods = synthetic_kmods(n)
+        for name, kernel in KMOD_QUERIES:
+            t, runs = measure(lambda: LinbitDistribution.best_drbd_kmod(kmods, name=name, hostkernel=kernel))
+            results.append({'name': 'best_drbd_kmod', 'candidates': n, 'dist': name, 'seconds': t, 'runs': runs})
+
+        t, runs = measure(lambda: KmodCandidates(kmods))
+        results.append({'name': 'kmod_candidates_parse', 'candidates': n, 'seconds': t, 'runs': runs})
+        candidates = KmodCandidates(kmods)
+
+        path = os.path.join(tmpdir, 'kmods.idx')
+        t, runs = measure(lambda: write_kmod_index(kmods, path))
+        results.append({'name': 'kmod_index_write', 'candidates': n, 'seconds': t, 'runs': runs})
+        index = KmodIndex(path)
+
+        for name, kernel in KMOD_QUERIES:
+            t, runs = measure(lambda: candidates.best(name, kernel))
+            results.append({'name': 'kmod_candidates_best', 'candidates': n, 'dist': name, 'seconds': t,
+                            'runs': runs})
+            t, runs = measure(lambda: index.best(name, kernel))
+            results.append({'name': 'kmod_index_best', 'candidates': n, 'dist': name, 'seconds': t, 'runs': runs})
+        index.close()
+    return results
+
+
+def make_roots(tmpdir):
+    roots = {}
+    for dist_id, files in sorted(FIXTURES.items()):
+        root = os.path.join(tmpdir, dist_id)
+        for path, content in files.items():
+            p = os.path.join(root, path)
+            if not os.path.isdir(os.path.dirname(p)):
+                os.makedirs(os.path.dirname(p))
+            with open(p, 'w') as f:
+                f.write(content)
+        roots[dist_id] = root
+    return roots
+
+
+def bench_detection(roots):
+    missing = set(Distribution(root=roots['rhel'])._supported_dist_IDs) - set(roots)
+    if missing:
+        raise Exception('No fixtures for: {0}'.format(', '.join(sorted(missing))))
+
+    results = []
+    for dist_id, root in sorted(roots.items()):
+        def detect():
+            d = LinbitDistribution(root=root)
+            try:
+                d.repo_name
+            except Exception:
+                pass  # e.g., Proxmox versions of foreign roots
+            return d.family
+        t, runs = measure(detect)
+        results.append({'name': 'detect', 'dist': dist_id, 'seconds': t, 'runs': runs})
+    return results
+
+
+class _StubServer(object):
+    # local stand-in for the best module API
+    def __init__(self):
+        import threading
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                answer = b'kmod-drbd-9.1.12_4.18.0_372.9.1.el8_6-1.x86_64.rpm'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}/api/v1/best/'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def bench_epilogue(roots):
+    results = []
+    server = _StubServer()
+    try:
+        for dist_id in ('rhel', 'sles', 'ubuntu'):
+            d = LinbitDistribution(root=roots[dist_id])
+            d._best_module_url = server.url
+            t, runs = measure(lambda: d.epilogue(cachedir=False))
+            results.append({'name': 'epilogue', 'dist': dist_id, 'seconds': t, 'runs': runs})
+    finally:
+        server.close()
+    return results
+
+
+def bench_cli(roots, runs):
+    results = []
+    tool = os.path.join(HERE, 'lbdisttool.py')
+    osrelease = os.path.join(roots['rhel'], 'etc', 'os-release')
+    for flag in ('-l', '-f', '-a'):
+        cmd = [sys.executable, tool, '--os-release', osrelease, flag]
+        t, n = measure(lambda: subprocess.check_call(cmd, stdout=subprocess.PIPE), repeat=runs)
+        results.append({'name': 'cli', 'args': flag, 'seconds': t, 'runs': n})
+    return results
+
+
+def _key(r):
+    return tuple(sorted((k, v) for k, v in r.items() if k not in ('seconds', 'runs')))
+
+
+def compare(results, baseline, max_regression, noise_floor=0):
+    # returns the results that got slower than baseline by more than max_regression (relative)
+    # and by more than noise_floor seconds, smaller differences are within what timing a call can tell apart
+    base = dict((_key(r), r['seconds']) for r in baseline['results'])
+    slower = []
+    for r in results:
+        b = base.get(_key(r))
+        if b and r['seconds'] > b * (1 + max_regression) and r['seconds'] - b > noise_floor:
+            slower.append((r, b))
+    return slower
+
+
+def fastest(*runs):
+    # per benchmark the result of the run where it was fastest
+    best = {}
+    for results in runs:
+        for r in results:
+            k = _key(r)
+            if k not in best or r['seconds'] < best[k]['seconds']:
+                best[k] = r
+    return [best[_key(r)] for r in runs[0]]
+
+
+def run(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        roots = make_roots(tmpdir)
+        results = []
+        results += bench_detection(roots)
+        results += bench_epilogue(roots)
+        results += bench_cli(roots, args.cli_runs)
+        results += bench_kmods(args.sizes, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='lbdist benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000, 1000000],
+                        help='Numbers of kmod candidates')
+    parser.add_argument('--cli-runs', type=int, default=5,
+                        help='Number of timed batches of lbdisttool.py runs per query, the median counts')
+    parser.add_argument('--output', help='Write results to this file instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='Fail if results are slower than BASELINE, in this and in a second run')
+    parser.add_argument('--max-regression', type=float, default=1.0,
+                        help='Allowed relative slow down compared to BASELINE')
+    parser.add_argument('--noise-floor', type=float, default=0.00001, metavar='SECONDS',
+                        help='Allowed absolute slow down compared to BASELINE')
+    args = parser.parse_args()
+
+    results = run(args)
+    slower = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.max_regression, args.noise_floor):
+            # a regression has to show up again, a single run is easily disturbed by something else on the host
+            results = fastest(results, run(args))
+            slower = compare(results, baseline, args.max_regression, args.noise_floor)
+
+    out = json.dumps({'python': sys.version.split()[0], 'results': results}, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+    for r, b in slower:
+        sys.stderr.write('regression: {0}: {1:.6f}s (baseline {2:.6f}s)\n'.format(
+            dict(_key(r)), r['seconds'], b))
+    if slower:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,2 @@
 from .distribution import Distribution, LinbitDistribution
+from .kmod import KmodCandidates, KmodIndex, write_kmod_index
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from .cache import _private_dir, _write_json, cache_dir
+
+try:
+    from urllib2 import urlopen
+    from urllib2 import Request
+    from urllib2 import HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.request import Request
+    from urllib.error import HTTPError
+
+# TODO: give it a dedicated subdomain with standard port
+BEST_MODULE_URL = 'http://drbd.io:3030/api/v1/best/'
+
+# how long answers are reused, and how long we don't even try once the endpoint was not reachable
+BEST_MODULE_TTL = 3600
+UNREACHABLE_TTL = 600
+
+# what an answer has to look like, it ends up in the install command we print
+_PACKAGE_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.+~-]*$')
+
+
+def _digest(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(p.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _package_name(best):
+    if best is not None and not _PACKAGE_NAME.match(best):
+        return None
+    return best
+
+
+def _read_entry(path, ttl):
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+        age = time.time() - entry['time']
+        if 0 <= age <= ttl:  # entries from the future (clock changes, tampering) are stale as well
+            return entry
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _write_entry(path, entry):
+    try:
+        entry['time'] = time.time()
+        _write_json(path, entry)
+    except (IOError, OSError):
+        pass  # the cache is an optimization only
+
+
+def fetch_best_module(uname_r, osrelease, url=BEST_MODULE_URL, timeout=5, cachedir=False):
+    # asks the LINBIT API for the best kmod package for this kernel and the content of os-release
+    # returns the package name (without .rpm) or None if there is no answer
+    # cachedir: where answers are cached, False (default) to disable caching, None for the default directory
+    # of the detection cache (lbdist.cache.cache_dir), nothing is cached in a directory that is not private
+    if cachedir is None:
+        cachedir = cache_dir()
+    if cachedir and not _private_dir(cachedir):
+        cachedir = False
+
+    if cachedir:
+        unreachable = os.path.join(cachedir, 'unreachable-{0}.json'.format(_digest(url)))
+        if _read_entry(unreachable, UNREACHABLE_TTL) is not None:
+            return None
+        answer = os.path.join(cachedir, 'best-{0}.json'.format(_digest(url, uname_r, osrelease)))
+        entry = _read_entry(answer, BEST_MODULE_TTL)
+        if entry is not None and _package_name(entry['best']) == entry['best']:
+            return entry['best']
+
+    req = Request(url + uname_r, data=osrelease.encode())
+    try:
+        resp = urlopen(req, timeout=timeout)
+        best = resp.read().decode()
+        # returns a file name including .rpm, split that off
+        # pkgmanagers like dnf don't like extensions/look for local files,...
+        best = _package_name(os.path.splitext(best)[0])
+    except HTTPError:
+        best = None  # reachable, but nothing it could handle
+    except Exception:
+        if cachedir:
+            _write_entry(unreachable, {})
+        return None
+
+    if cachedir:
+        _write_entry(answer, {'best': best})
+    return best
+
+
+def start_best_module(uname_r, osrelease, url=BEST_MODULE_URL, timeout=5, cachedir=False):
+    # runs fetch_best_module in the background, returns a function that waits for and returns its result
+    result = {}
+
+    def run():
+        try:
+            result['best'] = fetch_best_module(uname_r, osrelease, url, timeout, cachedir)
+        except Exception:
+            pass
+
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+
+    def wait():
+        t.join()
+        return result.get('best')
+    return wait
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import stat
+import tempfile
+
+from .distribution import Distribution, LinbitDistribution, _root_path
+
+# bump if the cached state changes
+_CACHE_VERSION = 1
+
+
+def cache_dir():
+    # per user and cleared on reboot if XDG_RUNTIME_DIR is set, otherwise a private directory in /tmp
+    # None if that is not ours (e.g., someone else created /tmp/lbdist-<uid> first), then nothing gets cached
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if not base:
+        base = os.path.join('/tmp', 'lbdist-{0}'.format(os.getuid()))
+        if not _private_dir(base):
+            return None
+    return os.path.join(base, 'lbdist')
+
+
+def _private_dir(path):
+    # creates the missing levels of path, returns whether path is a directory only we have access to
+    # checked with lstat, a symlink (even to a directory of ours) does not count
+    missing = []
+    p = os.path.abspath(path)
+    while not os.path.lexists(p):
+        missing.append(p)
+        p = os.path.dirname(p)
+    for p in reversed(missing):
+        try:
+            os.mkdir(p, 0o700)
+        except OSError:
+            pass  # created concurrently, or the check below fails anyway
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0o700
+
+
+def _write_json(path, obj):
+    # readers see either the old or the complete new file
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.rename(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_ino, st.st_size, st.st_ctime]
+
+
+def _key(osreleasepath, root):
+    # everything detection depends on, package upgrades change the mtime/inode of the release files
+    files = (osreleasepath, Distribution._pveversion, Distribution._centosrelease, Distribution._redhatrelease,
+             Distribution._dpkgstatus)
+    key = [_CACHE_VERSION, os.path.abspath(osreleasepath), root, os.uname()[2]]
+    key += [_stat(_root_path(root, f)) for f in files]
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def cached_distribution(osreleasepath='/etc/os-release', root=None, cachedir=None, tracer=None, probe=None):
+    # like LinbitDistribution(osreleasepath, root), but reuses the result of earlier calls (also from other
+    # processes) as long as the release files and the kernel did not change
+    cachedir = cachedir or cache_dir()
+    if cachedir is None or not _private_dir(cachedir):
+        return LinbitDistribution(osreleasepath, root, probe=probe, tracer=tracer)
+    path = os.path.join(cachedir, _key(osreleasepath, root) + '.json')
+
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        d = LinbitDistribution._from_state(state, osreleasepath, root)
+        d._tracer = tracer
+        d._probe = probe
+        return d
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    d = LinbitDistribution(osreleasepath, root, probe=probe, tracer=tracer)
+    try:
+        state = d._state()
+        state['repo_name'] = d.repo_name
+    except Exception:
+        return d  # do not cache what is not detectable, errors show up on access as usual
+
+    try:
+        _write_json(path, state)
+    except (IOError, OSError):
+        pass  # the cache is an optimization only
+    return d
+
+
+def flush_cache(cachedir=None):
+    cachedir = cachedir or cache_dir()
+    if cachedir is None:
+        return
+    try:
+        entries = os.listdir(cachedir)
+    except OSError:
+        return
+    for e in entries:
+        if e.endswith('.json') or e.endswith('.tmp'):
+            try:
+                os.unlink(os.path.join(cachedir, e))
+            except OSError:
+                pass
@@ -1,35 +1,224 @@
 #!/usr/bin/env python
 import os
-import re
-import subprocess
-import platform
-from functools import reduce
 
-try:
-    from urllib2 import urlopen
-    from urllib2 import Request
-except ImportError:
-    from urllib.request import urlopen
-    from urllib.request import Request
+# keep imports at module level to a minimum, most users only need name/version/family/repo_name
+# everything else (subprocess for Proxmox, platform/functools for best_drbd_kmod,...) is imported where it is used
+
+
+def _root_path(root, path):
+    if root is None:
+        return path
+    p = os.path.join(root, path.lstrip('/'))
+    # absolute symlinks (/etc/os-release -> /usr/lib/os-release) have to stay below root
+    for _ in range(8):
+        if not os.path.islink(p):
+            break
+        target = os.readlink(p)
+        if target.startswith('/'):
+            p = os.path.join(root, target.lstrip('/'))
+        else:
+            p = os.path.join(os.path.dirname(p), target)
+    return p
+
+
+def _install_tool(is_in_path):
+    # make sure to order by preference
+    if is_in_path('apt'):
+        return 'apt install'
+    if is_in_path('apt-get'):
+        return 'apt-get install'
+    if is_in_path('zypper'):
+        return 'zypper install'
+    if is_in_path('dnf'):
+        return 'dnf install'
+    if is_in_path('yum'):
+        return 'yum install'
+    return '<your package manager install>'
+
+
+# repo name rules per distribution ID, all of them take (ID, version, RHEL_VERSION)
+# use '{0}' instead of '{}', RHEL 6 does not handle the modern version
+def _repo_codename(dist_id, v, rhel_version):
+    return v
+
+
+def _repo_major_minor(d):
+    def rule(dist_id, v, rhel_version):
+        if '.' in v:
+            v = v.split('.')
+            v = v[0] + '.' + v[1]
+        else:
+            v += '.0'
+        return '{0}{1}'.format(d, v)
+    return rule
+
+
+def _repo_major(d):
+    def rule(dist_id, v, rhel_version):
+        if '.' in v:
+            v = v.split('.')[0]
+        return '{0}{1}'.format(d, v)
+    return rule
+
+
+def _repo_sles(dist_id, v, rhel_version):
+    if '.' in v:
+        v = v.split('.')
+        v = v[0] + '-sp' + v[1]
+    # else: TODO(rck): actually I don't know how non SPx looks like
+    # in the repo it is just like "sles12"
+    return 'sles{0}'.format(v)
+
+
+def _repo_proxmox(dist_id, v, rhel_version):
+    if '.' in v:
+        v = v.split('.')[0]
+    return 'proxmox-{0}'.format(v)
+
+
+# RHCOS version -> RHEL version, newer ones set RHEL_VERSION in os-release
+_RHCOS_RHEL = {
+    '4.1': '8.0',
+    '4.2': '8.0',
+    '4.3': '8.1',
+    '4.4': '8.1',
+    '4.5': '8.2',
+    '4.6': '8.2',
+    '4.7': '8.3',
+}
+
+
+def _repo_rhcos(dist_id, v, rhel_version):
+    return 'rhel{0}'.format(_RHCOS_RHEL.get(v) or rhel_version or '8.6')
+
+
+def _osrelease_record(osrelease):
+    # (ID, version as Distribution.version reports it, RHEL_VERSION) of an os-release dict, version is None if the
+    # os-release alone does not tell
+    dist_id = osrelease.get('ID')
+    version = osrelease.get('VERSION_ID')
+    if dist_id == 'ubuntu':
+        version = osrelease.get('VERSION_CODENAME')
+    elif dist_id == 'debian':  # like Distribution._version_debian, testing/sid has no VERSION
+        import re
+        m = re.search(r'^\d+ \((\w+)\)$', osrelease.get('VERSION', ''))
+        version = m and m.group(1)
+    return dist_id, version, osrelease.get('RHEL_VERSION')
+
+
+_repo_name_rules = {
+    'debian': _repo_codename,
+    'ubuntu': _repo_codename,
+    'rhel': _repo_major_minor('rhel'),
+    'centos': _repo_major_minor('rhel'),
+    'amzn': _repo_major_minor('amazonlinux'),
+    'almalinux': _repo_major_minor('rhel'),
+    'rocky': _repo_major_minor('rhel'),
+    'xenenterprise': _repo_major('xenserver'),
+    'ol': _repo_major('ol'),
+    'sles': _repo_sles,
+    'opensuse-leap': _repo_sles,
+    'proxmox': _repo_proxmox,
+    'rhcos': _repo_rhcos,
+}
 
 
 class Distribution(object):
     _pveversion = '/usr/bin/pveversion'
+    _centosrelease = '/etc/centos-release'
+    _redhatrelease = '/etc/redhat-release'
+    _dpkgstatus = '/var/lib/dpkg/status'
+
+    def __init__(self, osreleasepath='/etc/os-release', root=None, probe=None, tracer=None):
+        # root: detect the distribution of a root file system (chroot, unpacked container image) instead of the host
+        # all paths, including osreleasepath, are then relative to root
+        # probe: a lbdist.hostprobe.HostProbe used for file checks, shared with epilogue
+        # tracer: called as tracer(phase, seconds, error) after every phase of detection and epilogue,
+        # error is None if the phase succeeded
+        self._setup(osreleasepath, root, probe, tracer)
 
-    def __init__(self, osreleasepath='/etc/os-release'):
+        self._measured('osrelease', self._update_osrelease)
+
+        self._name = self._osrelease.get('ID')
+        if self._name not in self._supported_dist_IDs:
+            raise Exception("Could not determine distribution info")
+
+    def _setup(self, osreleasepath, root, probe=None, tracer=None):
         self._supported_dist_IDs = ('amzn', 'centos', 'rhel', 'rhcos', 'almalinux', 'rocky', 'debian',
                                     'ubuntu', 'xenenterprise', 'ol', 'sles', 'opensuse-leap', 'proxmox')
         self._osreleasepath = osreleasepath
+        self._root = root
+        self._probe = probe
+        self._tracer = tracer
+
+        # work done for detection (see work), only the os-release part is done eagerly
+        # version and family are determined on first access, e.g. pveversion is only executed if the version is needed
+        self._counts = {'stat': 0, 'read': 0, 'exec': 0}
+        self._work = {}
 
         self._osrelease = {}
-        self._update_osrelease()
+        self._name = None
+        self._version = None
+        self._family = None
 
-        self._name = self._osrelease.get('ID')
-        if self._name not in self._supported_dist_IDs:
-            raise Exception("Could not determine distribution info")
+    def _state(self):
+        # everything detection found out, enough to recreate the object via _from_state
+        return {'osrelease': self._osrelease, 'name': self._name, 'version': self.version, 'family': self.family}
 
-        self._update_version()
-        self._update_family()
+    @classmethod
+    def _from_state(cls, state, osreleasepath='/etc/os-release', root=None):
+        d = cls.__new__(cls)
+        d._setup(osreleasepath, root)
+        d._osrelease = state['osrelease']
+        d._name = state['name']
+        d._version = state['version']
+        d._family = state['family']
+        return d
+
+    def _traced(self, phase, fn):
+        # returns fn(), reports how long it took to the tracer if there is one
+        if self._tracer is None:
+            return fn()
+        import time
+        start = time.time()
+        try:
+            ret = fn()
+        except Exception as e:
+            self._tracer(phase, time.time() - start, e)
+            raise
+        self._tracer(phase, time.time() - start, None)
+        return ret
+
+    def _measured(self, phase, update):
+        before = dict(self._counts)
+        try:
+            self._traced(phase, update)
+        finally:
+            self._work[phase] = dict((k, self._counts[k] - before[k]) for k in self._counts)
+
+    @property
+    def work(self):
+        # phase ('osrelease', 'version', 'family') -> number of file system checks, file reads, executed programs
+        # phases that did not run yet are missing
+        return dict((k, dict(v)) for k, v in self._work.items())
+
+    def _path(self, path):
+        return _root_path(self._root, path)
+
+    def _exists(self, path):
+        self._counts['stat'] += 1
+        if self._probe is not None:
+            return self._probe.exists(self._path(path))
+        return os.path.exists(self._path(path))
+
+    def _open(self, path, mode='r'):
+        self._counts['read'] += 1
+        return open(self._path(path), mode)
+
+    def _check_output(self, cmd):
+        import subprocess
+        self._counts['exec'] += 1
+        return subprocess.check_output(cmd)
 
     @property
     def osrelease(self):
@@ -39,11 +228,11 @@ class Distribution(object):
         # gernates a slightly oppinionated osrelease dict that is similar to /etc/os-release
         # for very old distris it just sets the bare minimum to determine version and family
         osrelease = {}
-        if os.path.exists(Distribution._pveversion):
+        if self._exists(Distribution._pveversion):
             osrelease['ID'] = 'proxmox'
             osrelease['ID_LIKE'] = 'debian'
-        elif os.path.exists(self._osreleasepath):
-            with open(self._osreleasepath) as o:
+        elif self._exists(self._osreleasepath):
+            with self._open(self._osreleasepath) as o:
                 for line in o:
                     line = line.strip()
                     if len(line) == 0 or line[0] == '#':
@@ -60,74 +249,115 @@ class Distribution(object):
                 osrelease['ID_LIKE'] = 'sles'
 
         # centos 6, centos first, as centos has centos-release and redhat-release
-        elif os.path.exists('/etc/centos-release'):
+        elif self._exists(Distribution._centosrelease):
             osrelease['ID'] = 'centos'
             osrelease['ID_LIKE'] = 'rhel'
         # rhel 6
-        elif os.path.exists('/etc/redhat-release'):
+        elif self._exists(Distribution._redhatrelease):
             osrelease['ID'] = 'rhel'
 
         self._osrelease = osrelease
 
-    def _update_version(self):
-        version = None
-
-        if self._name == 'debian':
-            try:
-                v = self._osrelease['VERSION']
-            except KeyError:
-                msg = 'No "VERSION" in your Debian {0}, are you running testing/sid?'.format(self._osreleasepath)
-                raise Exception(msg)
-
-            m = re.search(r'^\d+ \((\w+)\)$', v)
-            if not m:
-                raise Exception('Could not determine version information for your Debian')
-            version = m.group(1)
-        elif self._name == 'ubuntu':
-            version = self._osrelease['VERSION_CODENAME']
-        elif self._name == 'centos':
+    def _version_id(self):
+        return self._osrelease['VERSION_ID']
+
+    def _version_debian(self):
+        try:
+            v = self._osrelease['VERSION']
+        except KeyError:
+            msg = 'No "VERSION" in your Debian {0}, are you running testing/sid?'.format(self._osreleasepath)
+            raise Exception(msg)
+
+        import re
+        m = re.search(r'^\d+ \((\w+)\)$', v)
+        if not m:
+            raise Exception('Could not determine version information for your Debian')
+        return m.group(1)
+
+    def _version_ubuntu(self):
+        return self._osrelease['VERSION_CODENAME']
+
+    def _version_centos(self):
+        line = ''
+        with self._open(Distribution._centosrelease) as cr:
+            line = cr.readline().strip()
+        # .* because the nice centos people changed their string between 6 and 7 (added 'Linux')
+        # and again in the middle of the 8 series (removed '(Core|Final)')
+        import re
+        m = re.search(r'^CentOS .* ([\d.]+)', line)
+        if not m:
+            raise Exception('Could not determine version information for your Centos')
+        return m.group(1)
+
+    def _version_rhel(self):
+        try:
+            return self._osrelease['VERSION_ID']
+        except KeyError:
             line = ''
-            with open('/etc/centos-release') as cr:
+            with self._open(Distribution._redhatrelease) as cr:
                 line = cr.readline().strip()
-            # .* because the nice centos people changed their string between 6 and 7 (added 'Linux')
-            # and again in the middle of the 8 series (removed '(Core|Final)')
-            m = re.search(r'^CentOS .* ([\d.]+)', line)
+            import re
+            m = re.search(r'^Red Hat Enterprise .* ([\d.]+) \(.*\)$', line)
             if not m:
-                raise Exception('Could not determine version information for your Centos')
-            version = m.group(1)
-        elif self._name == 'amzn':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'almalinux':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'rocky':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'rhel':
-            try:
-                version = self._osrelease['VERSION_ID']
-            except KeyError:
-                line = ''
-                with open('/etc/redhat-release') as cr:
-                    line = cr.readline().strip()
-                m = re.search(r'^Red Hat Enterprise .* ([\d.]+) \(.*\)$', line)
-                if not m:
-                    raise Exception('Could not determine version information for your RHEL6')
-                version = m.group(1)
-        elif self._name == 'rhcos':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'xenenterprise':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'ol':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'sles' or self._name == 'opensuse-leap':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'proxmox':
-            version = subprocess.check_output([Distribution._pveversion]).decode().strip().split('/')[1]
-            # this gave us something like 7.2-5, cut the '-' part
-            version = version.split('-')[0]
-        else:
-            raise Exception("Could not determine version information")
+                raise Exception('Could not determine version information for your RHEL6')
+            return m.group(1)
+
+    def _dpkg_version(self, package):
+        # version of an installed package from the dpkg status database, None if it is not there
+        # the database is large, it is read line by line up to the entry of the package
+        want = ('Package: ' + package).encode()
+        try:
+            f = self._open(Distribution._dpkgstatus, 'rb')
+        except (IOError, OSError):
+            return None
+        with f:
+            found, installed, version = False, False, None
+            for line in f:
+                line = line.rstrip()
+                if not found:
+                    found = line == want
+                elif not line:  # end of the entry
+                    if installed:
+                        return version
+                    found, installed, version = False, False, None
+                elif line.startswith(b'Status: '):
+                    installed = line.split()[-1] == b'installed'
+                elif line.startswith(b'Version: '):
+                    version = line[len(b'Version: '):].decode('ascii', 'replace')
+        return version if found and installed else None
+
+    def _version_proxmox(self):
+        # pveversion reports the version of pve-manager, but starting it (perl, PVE libraries) is slow
+        version = self._dpkg_version('pve-manager')
+        if version is None:
+            if self._root is not None:
+                raise Exception('Could not determine version information for Proxmox outside of the host')
+            version = self._check_output([Distribution._pveversion]).decode().strip().split('/')[1]
+        # this gave us something like 7.2-5, cut the '-' part
+        return version.split('-')[0]
+
+    # distribution ID -> how its version is determined
+    _version_rules = {
+        'debian': _version_debian,
+        'ubuntu': _version_ubuntu,
+        'centos': _version_centos,
+        'amzn': _version_id,
+        'almalinux': _version_id,
+        'rocky': _version_id,
+        'rhel': _version_rhel,
+        'rhcos': _version_id,
+        'xenenterprise': _version_id,
+        'ol': _version_id,
+        'sles': _version_id,
+        'opensuse-leap': _version_id,
+        'proxmox': _version_proxmox,
+    }
 
-        self._version = version
+    def _update_version(self):
+        rule = self._version_rules.get(self._name)
+        if rule is None:
+            raise Exception("Could not determine version information")
+        self._version = rule(self)
 
     def _update_family(self):
         family = None
@@ -151,124 +381,102 @@ class Distribution(object):
 
     @property
     def version(self):
+        if self._version is None:
+            self._measured('version', self._update_version)
         return self._version
 
     @property
     def family(self):
+        if self._family is None:
+            self._measured('family', self._update_family)
         return self._family
 
 
 class LinbitDistribution(Distribution):
-    def __init__(self, osreleasepath='/etc/os-release'):
-        super(LinbitDistribution, self).__init__(osreleasepath)
+    def __init__(self, osreleasepath='/etc/os-release', root=None, probe=None, tracer=None):
+        super(LinbitDistribution, self).__init__(osreleasepath, root, probe, tracer)
 
     @property
     def repo_name(self):
-        # use '{0}' instead of '{}', RHEL 6 does not handle the modern version
-        if self._name in ('debian', 'ubuntu'):
-            return self._version
-        elif self._name in ('rhel', 'centos', 'amzn', 'almalinux', 'rocky'):
-            d = 'rhel'
-            if self._name == 'amzn':
-                d = 'amazonlinux'
-
-            v = self._version
-            if '.' in v:
-                v = v.split('.')
-                v = v[0] + '.' + v[1]
-            else:
-                v += '.0'
-            return '{0}{1}'.format(d, v)
-        elif self._name in ('xenenterprise', 'ol'):
-            d = self._name
-            if self._name == 'xenenterprise':
-                d = 'xenserver'
-            v = self._version
-            if '.' in v:
-                v = v.split('.')[0]
-            return '{0}{1}'.format(d, v)
-        elif self._name == 'sles' or self._name == 'opensuse-leap':
-            v = self._version
-            if '.' in v:
-                v = v.split('.')
-                v = v[0] + '-sp' + v[1]
-            # else: TODO(rck): actually I don't know how non SPx looks like
-            # in the repo it is just like "sles12"
-            return 'sles{0}'.format(v)
-        elif self._name == 'proxmox':
-            v = self._version
-            if '.' in v:
-                v = v.split('.')
-                v = v[0]
-            return 'proxmox-{0}'.format(v)
-        elif self._name == 'rhcos':
-            osrel_ver = self.osrelease.get('RHEL_VERSION')
-            vs = {
-                '4.1': '8.0',
-                '4.2': '8.0',
-                '4.3': '8.1',
-                '4.4': '8.1',
-                '4.5': '8.2',
-                '4.6': '8.2',
-                '4.7': '8.3',
-            }
-            return 'rhel{0}'.format(vs.get(self._version) or osrel_ver or '8.6')
-        else:
+        rule = _repo_name_rules.get(self._name)
+        if rule is None:
             raise Exception("Could not determine repository information")
+        return rule(self._name, self.version, self.osrelease.get('RHEL_VERSION'))
 
-    def epilogue(self, with_pacemaker=False):
-        # we want to support old Python, "which" is easy enough
-        def is_in_path(executable):
-            path = os.getenv('PATH')
-            if not path:
-                return False
-            for p in path.split(os.path.pathsep):
-                p = os.path.join(p, executable)
-                if os.path.exists(p) and os.access(p, os.X_OK):
-                    return True
-            return False
-
-        def get_install_tool():
-            # make sure to order by preference
-            if is_in_path('apt'):
-                return 'apt install'
-            if is_in_path('apt-get'):
-                return 'apt-get install'
-            if is_in_path('zypper'):
-                return 'zypper install'
-            if is_in_path('dnf'):
-                return 'dnf install'
-            if is_in_path('yum'):
-                return 'yum install'
-            return '<your package manager install>'
-
-        def get_best_module():
-            uname_r = os.uname()[2]
-            if self._family == 'debian':
-                return 'drbd-module-{0} # or drbd-dkms'.format(uname_r)
+    @classmethod
+    def repo_names(cls, records):
+        # bulk version of repo_name for inventories: yields the repo name per record, records are either
+        # os-release dicts or (ID, VERSION_ID, RHEL_VERSION) tuples
+        # Debian and Ubuntu repos are named after the code name (from VERSION or VERSION_CODENAME, like
+        # repo_name does, so they need a dict) and CentOS ones after the minor release from centos-release,
+        # these raise if it is not there
+        # records repeat a lot in practice, so every distinct one is only mapped once
+        seen = {}
+        for record in records:
+            if isinstance(record, dict):
+                dist_id, version, rhel_version = _osrelease_record(record)
+            else:
+                dist_id, version, rhel_version = record
+                if dist_id in ('debian', 'ubuntu'):
+                    version = None
+            key = (dist_id, version, rhel_version if dist_id == 'rhcos' else None)
+            repo = seen.get(key)
+            if repo is None:
+                rule = _repo_name_rules.get(dist_id)
+                if rule is None or not version or dist_id == 'centos':
+                    raise Exception("Could not determine repository information for {0}".format(record))
+                repo = seen[key] = rule(*key)
+            yield repo
+
+    # where epilogue asks for the best kernel module, see lbdist.bestmodule
+    _best_module_url = None
+
+    def epilogue(self, with_pacemaker=False, cachedir=False):
+        # cachedir: cache for the best module lookup, False (default) to disable it, None for the default directory
+        # one probe answers all the PATH lookups, see lbdist.hostprobe
+        from .hostprobe import HostProbe
+        probe = self._probe
+        if probe is None:
+            probe = HostProbe()
+        is_in_path = probe.is_in_path
+
+        def lookup_best_module():
             # something bestkernelmodule should be able to handle
             # it is fine if this is something bestkernelmodule does not handle,
-            # it will raise an exception and we return the default kmod-drbd
-            os_release = open(self._osreleasepath)
+            # then we return the default kmod-drbd
+            # the lookup runs while we look for the install tools
+            if self.family == 'debian':
+                return None
+            from .bestmodule import start_best_module, BEST_MODULE_URL
+            os_release = self._open(self._osreleasepath)
             data = os_release.read()
             os_release.close()
-            # TODO: give it a dedicated subdomain with standard port
-            req = Request('http://drbd.io:3030/api/v1/best/'+uname_r, data=data.encode())
-            try:
-                resp = urlopen(req, timeout=5)
-                best = resp.read().decode()
-                # returns a file name including .rpm, split that off
-                # pkgmanagers like dnf don't like extensions/look for local files,...
-                return os.path.splitext(best)[0]
-            except Exception:
-                # sles or rhel alike:
-                kmod = '<no default kernel module for your distribution>'
-                if self._family == 'rhel':
-                    kmod = 'kmod-drbd'
-                elif self._family == 'sles':
-                    kmod = 'drbd-kmp'
-                return kmod
-
+            return start_best_module(uname_r, data, url=self._best_module_url or BEST_MODULE_URL, cachedir=cachedir)
+
+        traced = self._traced
+        uname_r = traced('uname', lambda: probe.uname()[2])
+        lookup = traced('best_module_start', lookup_best_module)
+        install_tool = traced('install_tool', lambda: _install_tool(is_in_path))
+        oned = traced('oned', lambda: is_in_path('oned'))
+        best_module = traced('best_module', lambda: self._best_module(uname_r, lookup))
+        return self._epilogue_text(install_tool, oned, best_module, with_pacemaker)
+
+    def _best_module(self, uname_r, lookup):
+        # lookup: returns the answer of the best module API, None for Debian alikes
+        if self.family == 'debian':
+            return 'drbd-module-{0} # or drbd-dkms'.format(uname_r)
+        best = lookup()
+        if best is not None:
+            return best
+        # sles or rhel alike:
+        kmod = '<no default kernel module for your distribution>'
+        if self.family == 'rhel':
+            kmod = 'kmod-drbd'
+        elif self.family == 'sles':
+            kmod = 'drbd-kmp'
+        return kmod
+
+    def _epilogue_text(self, install_tool, oned, best_module, with_pacemaker=False):
         def add_controller_satellite(tool, satellite_extra):
             return '\nIf this is an SDS controller node you might want to install:\n' \
                    '  {0} linbit-sds-controller\n' \
@@ -281,17 +489,15 @@ class LinbitDistribution(Distribution):
             return '\nIf you intend to use Pacemaker you might want to install:\n' \
                    '  {0} pacemaker corosync\n'.format(tool)
 
-        install_tool = get_install_tool()
-        best_module = get_best_module()
         utils = ''
-        if self._family == 'debian':
+        if self.family == 'debian':
             utils = 'drbd-utils'
-        elif self._family == 'sles' or self._family == 'rhel':
+        elif self.family == 'sles' or self.family == 'rhel':
             utils = 'drbd-utils drbd-udev'
 
         dist = 'GENERIC'
         doc = 'https://linbit.com/drbd-user-guide/linstor-guide-1_0-en/#p-administration'
-        if is_in_path('oned'):
+        if oned:
             dist = 'OpenNebula frontend'
             utils += ' linstor-opennebula'
             doc = 'https://linbit.com/drbd-user-guide/linstor-guide-1_0-en/#ch-opennebula-linstor'
@@ -317,94 +523,46 @@ class LinbitDistribution(Distribution):
     def best_drbd_kmod(cls, choices, osreleasepath='/etc/os-release', name=None, hostkernel=None):
         # choices should be kernel module packages, they are allowed to have a path prefix
         # the best matching one, or None is returned
+        best = cls.top_drbd_kmods(choices, 1, osreleasepath, name, hostkernel)
+        return best[0] if best else None
+
+    @classmethod
+    def top_drbd_kmods(cls, choices, k=None, osreleasepath='/etc/os-release', name=None, hostkernel=None):
+        # like best_drbd_kmod, but returns a list of up to k (None: all) matching kmods, the best first
+        # e.g., to try the next best one if installing the best one failed
         if not name:
             name = cls(osreleasepath)._name
 
-        # keep as startswith, which allows forcing rhel by setting the family as name
-        if not (name.startswith('rhel') or name.startswith('centos') or
-                name.startswith('almalinux') or name.startswith('rocky') or
-                name.startswith('sles')):
-            return None
+        from .kmod import KmodIndex, KmodCandidates, kmod_dist_supported, top_kmods
+
+        if not kmod_dist_supported(name):
+            return []
 
         if not hostkernel:
+            import platform
             hostkernel = platform.uname()[2]
-        hostkernelsplit = hostkernel.replace('-', '.')
-        hostkernelsplit = hostkernelsplit.split('.')[::-1]
-        # strip x86, -default,... from the end
-        for i, e in enumerate(hostkernelsplit):
-            if e.isdigit():
-                hostkernelsplit = hostkernelsplit[i:][::-1]
-                break
-
-        kmap = {}
-        for c in choices:
-            kpart = os.path.basename(c)
-            if not (kpart.startswith('kmod-drbd') or kpart.startswith('drbd-kmp')):
-                continue
-            kpart = '_'.join(kpart.split('_')[1:])  # strip kmod-drbd-x.y.z_ prefix
-            if name.startswith('sles') and kpart[0] == 'k':  # strip k from k4.12.14_197.29-1
-                kpart = kpart[1:]
-
-            kpart = kpart.split('-')[0]  # strip revision and everything past it
-            # convert the '_' in 3.10.0_1062,
-            # but only the first one as in 4.18.0_80.1.2.el8_0.x86_64
-            kpart = kpart.replace('_', '.', 1)
-
-            kps = kpart.split('.')
-            # the weird stuff should now be at the end of the array (arch, el*)
-            kps = list(filter(lambda a: a.isdigit(), kps))
-            if len(kps) < 3:  # first 3 are the kernel
-                continue
-            valid = True
-
-            for i in range(3):
-                if hostkernelsplit[i] != kps[i]:
-                    valid = False
-                    break
-            if not valid:
-                continue
-
-            kmap['.'.join(kps[3:])] = c
-
-        hostkernelsplit = hostkernelsplit[3:]
-
-        def kcmp(v1, v2):
-            v1s, v2s = v1.split('.'), v2.split('.')
-            hks = hostkernelsplit
-
-            ml = max(len(hks), len(v1s), len(v2s))
-            for lst in (v1s, v2s, hks):
-                lst += [0]*(ml-len(lst))
-
-            for i, e in enumerate(hks):
-                e = int(e)
-                d1 = e - int(v1s[i])
-                d2 = e - int(v2s[i])
-                if d1 == d2:
-                    continue
-                # smaller positive one
-                if d1 >= 0 and d2 >= 0:
-                    if d1 < d2:
-                        return v1
-                    else:
-                        return v2
-                elif d1 >= 0 and d2 < 0:
-                    return v1
-                elif d1 < 0 and d2 >= 0:
-                    return v2
-                else:  # both negative and therefore higher
-                    if d1 < d2:
-                        return v2
-                    else:
-                        return v1
-
-            # no winner as there was no early return
-            return v1
-
-        keys = kmap.keys()
-        if not keys:
-            return None
-        return kmap[reduce(kcmp, keys)]
+
+        if isinstance(choices, (KmodIndex, KmodCandidates)):
+            return choices.top(name, hostkernel, k)
+        return top_kmods(choices, name, hostkernel, k)
+
+    @classmethod
+    def best_drbd_kmods(cls, choices, queries, osreleasepath='/etc/os-release'):
+        # batch version of best_drbd_kmod: choices get parsed once, queries is an iterable of (name, hostkernel)
+        # tuples, None values get detected like in best_drbd_kmod
+        # yields the best matching kmod or None per query, queries are consumed lazily
+        from .kmod import KmodIndex, KmodCandidates
+
+        if not isinstance(choices, (KmodIndex, KmodCandidates)):
+            choices = KmodCandidates(choices)
+
+        detected = None
+        for name, hostkernel in queries:
+            if not name:
+                if detected is None:
+                    detected = cls(osreleasepath)._name
+                name = detected
+            yield cls.best_drbd_kmod(choices, name=name, hostkernel=hostkernel)
 
 
 if __name__ == "__main__":
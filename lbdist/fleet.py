@@ -0,0 +1,159 @@
+import asyncio
+import os
+
+from urllib.parse import urlsplit
+
+from .bestmodule import BEST_MODULE_URL, _package_name
+from .distribution import LinbitDistribution, _install_tool
+from .images import ImageDistribution, _norm
+
+# Epilogues for many hosts at once from collected data (Python 3, asyncio)
+#
+# A host is a dict:
+#   "osrelease": content of its /etc/os-release
+#   "kernel": its uname -r
+#   "executables": names of the executables in its PATH (optional, used like LinbitDistribution.epilogue does)
+#   "files": {path: content} of further release files, e.g., /etc/centos-release (optional)
+#   "name": used in error messages (optional)
+
+
+class BestModuleClient(object):
+    # asks the best module API over at most concurrency keep-alive connections
+    # identical requests that are in flight (or done) are sent only once
+    # like lbdist.bestmodule.fetch_best_module, the answer is None if there is none within timeout seconds
+    # create it within the running event loop
+
+    def __init__(self, url=BEST_MODULE_URL, concurrency=8, timeout=5):
+        u = urlsplit(url)
+        self._https = u.scheme == 'https'
+        self._host = u.hostname
+        self._port = u.port or (443 if self._https else 80)
+        self._hostheader = u.netloc
+        self._path = u.path or '/'
+        self._timeout = timeout
+        self._slots = asyncio.Semaphore(concurrency)
+        self._idle = []  # connections not in use, (reader, writer)
+        self._requests = {}  # (uname_r, osrelease) -> task
+        self.connections = 0
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    async def best_module(self, uname_r, osrelease):
+        key = (uname_r, osrelease)
+        task = self._requests.get(key)
+        if task is None:
+            task = self._requests[key] = asyncio.ensure_future(self._fetch(uname_r, osrelease.encode()))
+        return await asyncio.shield(task)  # one waiter giving up does not cancel it for the others
+
+    async def _fetch(self, uname_r, body):
+        async with self._slots:
+            try:
+                status, data = await asyncio.wait_for(self._request(uname_r, body), self._timeout)
+            except (asyncio.TimeoutError, OSError, EOFError, ValueError):
+                return None
+        if status // 100 != 2:
+            return None  # reachable, but nothing it could handle
+        # returns a file name including .rpm, split that off
+        # it ends up in the install command, so only what looks like a package name counts
+        try:
+            return _package_name(os.path.splitext(data.decode())[0])
+        except UnicodeDecodeError:
+            return None
+
+    async def _request(self, uname_r, body):
+        # a reused connection might have been closed by the server meanwhile, then retry on a new one
+        while True:
+            reused = bool(self._idle)
+            if reused:
+                conn = self._idle.pop()
+            else:
+                conn = await asyncio.open_connection(self._host, self._port, ssl=self._https or None)
+                self.connections += 1
+            try:
+                status, data, keep = await self._roundtrip(conn, uname_r, body)
+            except (OSError, EOFError):
+                conn[1].close()
+                if reused:
+                    continue
+                raise
+            except BaseException:  # also when cancelled by the deadline, the connection is in an unknown state
+                conn[1].close()
+                raise
+            if keep:
+                self._idle.append(conn)
+            else:
+                conn[1].close()
+            return status, data
+
+    async def _roundtrip(self, conn, uname_r, body):
+        reader, writer = conn
+        head = 'POST {0} HTTP/1.1\r\nHost: {1}\r\nContent-Type: application/x-www-form-urlencoded\r\n' \
+               'Content-Length: {2}\r\n\r\n'.format(self._path + uname_r, self._hostheader, len(body))
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+        line = await reader.readline()
+        if not line:
+            raise EOFError('connection closed')
+        status = int(line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, _, v = line.decode('latin-1').partition(':')
+            headers[k.strip().lower()] = v.strip().lower()
+
+        keep = headers.get('connection') != 'close'
+        if 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            data = b''
+            while True:
+                n = int((await reader.readline()).split(b';')[0], 16)
+                chunk = await reader.readexactly(n + 2)
+                if n == 0:
+                    break
+                data += chunk[:-2]
+        else:
+            data = await reader.read()
+            keep = False
+        return status, data, keep
+
+
+def host_distribution(host):
+    # the LinbitDistribution of a host dict
+    files = {'etc/os-release': ('file', host['osrelease'].encode('utf-8'))}
+    for path, content in (host.get('files') or {}).items():
+        files[_norm(path)] = ('file', content.encode('utf-8'))
+    return ImageDistribution(files, host.get('name') or '<host>')
+
+
+async def host_epilogue(client, host, with_pacemaker=False):
+    # what LinbitDistribution.epilogue prints on host
+    d = host_distribution(host)
+    uname_r = host['kernel']
+    is_in_path = set(host.get('executables') or ()).__contains__
+    best = None
+    if d.family != 'debian':
+        best = await client.best_module(uname_r, host['osrelease'])
+    best_module = d._best_module(uname_r, lambda: best)
+    return d._epilogue_text(_install_tool(is_in_path), is_in_path('oned'), best_module, with_pacemaker)
+
+
+async def fleet_epilogues(hosts, url=None, concurrency=8, timeout=5, with_pacemaker=False):
+    # returns (epilogue, error) per host, in the order of hosts
+    client = BestModuleClient(url or LinbitDistribution._best_module_url or BEST_MODULE_URL, concurrency, timeout)
+
+    async def one(host):
+        try:
+            return await host_epilogue(client, host, with_pacemaker), None
+        except Exception as e:
+            return None, str(e)
+
+    try:
+        return await asyncio.gather(*[one(h) for h in hosts])
+    finally:
+        client.close()
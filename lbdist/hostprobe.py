@@ -0,0 +1,123 @@
+import errno
+import os
+import time
+
+
+def _list_dir(d, limit=None):
+    # returns {name: is_symlink}, is_symlink is None if unknown (old Python without scandir)
+    # None if d has more than limit entries (None: no limit), reading stops there
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        names = os.listdir(d)
+        return dict.fromkeys(names) if limit is None or len(names) <= limit else None
+
+    entries = {}
+    it = scandir(d)
+    try:
+        for e in it:
+            if len(entries) == limit:
+                return None
+            try:
+                entries[e.name] = e.is_symlink()  # from d_type, usually without a syscall
+            except OSError:
+                entries[e.name] = None
+    finally:
+        if hasattr(it, 'close'):
+            it.close()
+    return entries
+
+
+class HostProbe(object):
+    # answers "is this executable in PATH" and "does this file exist" with few file system accesses
+    # every PATH directory is listed once and answers all lookups in it, also exists() of files in there (e.g.,
+    # /usr/bin/pveversion), everything else is a stat()/access() per path, all results are kept
+    # share one probe between detection and epilogue (see Distribution), scan() collects PATH and uname up front
+    #
+    # seconds is the time spent on file system accesses, listings and checks count the listings and the
+    # stat()/access() calls, saved_checks the lookups answered from a listing instead of a stat()
+    # max_listing: PATH directories with more entries are checked per file instead (None: no limit)
+
+    def __init__(self, path=None, max_listing=None):
+        if path is None:
+            path = os.getenv('PATH', '')
+        self._pathdirs = []
+        for d in path.split(os.path.pathsep) if path else []:
+            if d not in self._pathdirs:
+                self._pathdirs.append(d)
+
+        self._max_listing = max_listing
+        self._dirs = {}  # directory -> {name: is_symlink}, None if it was not listed (too large, not readable)
+        self._exists = {}  # path -> bool
+        self._executable = {}  # path -> bool
+        self._uname = None
+        self.seconds = 0.0
+        self.listings = 0
+        self.checks = 0
+        self.saved_checks = 0
+
+    def _timed(self, fn, *args):
+        start = time.time()
+        try:
+            return fn(*args)
+        finally:
+            self.seconds += time.time() - start
+
+    def _listing(self, d):
+        if d not in self._dirs:
+            self.listings += 1
+            try:
+                self._dirs[d] = self._timed(_list_dir, d, self._max_listing)
+            except OSError as e:
+                self._dirs[d] = {} if e.errno in (errno.ENOENT, errno.ENOTDIR) else None
+        return self._dirs[d]
+
+    def _stat_exists(self, path):
+        if path not in self._exists:
+            self.checks += 1
+            self._exists[path] = self._timed(os.path.exists, path)
+        return self._exists[path]
+
+    def scan(self):
+        # everything epilogue asks for in one pass: the PATH listings and uname
+        for d in self._pathdirs:
+            self._listing(d or '.')
+        self.uname()
+
+    def exists(self, path):
+        # only answered from a listing if there already is one, a single file is cheaper to stat
+        d, name = os.path.split(path)
+        entries = self._dirs.get(d or '.')
+        if entries is None:
+            return self._stat_exists(path)
+        if name not in entries:
+            self.saved_checks += 1
+            return False
+        if entries[name] is False:
+            self.saved_checks += 1
+            return True
+        return self._stat_exists(path)  # symlinks might be dangling
+
+    def is_executable(self, path):
+        if path not in self._executable:
+            self.checks += 1
+            self._executable[path] = self._timed(os.access, path, os.X_OK)
+        return self._executable[path]
+
+    def is_in_path(self, executable):
+        for d in self._pathdirs:
+            entries = self._listing(d or '.')  # empty means cwd
+            p = os.path.join(d, executable)
+            if entries is None:
+                if not self._stat_exists(p):
+                    continue
+            elif executable not in entries:
+                self.saved_checks += 1
+                continue
+            if self.is_executable(p):
+                return True
+        return False
+
+    def uname(self):
+        if self._uname is None:
+            self._uname = self._timed(os.uname)
+        return self._uname
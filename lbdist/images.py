@@ -0,0 +1,150 @@
+import io
+import json
+import os
+import posixpath
+import tarfile
+
+from .distribution import Distribution, LinbitDistribution
+
+# everything distribution detection might look at, relative to the root of an image
+_RELEASE_FILES = frozenset(p.lstrip('/') for p in (Distribution._pveversion, Distribution._centosrelease,
+                                                   Distribution._redhatrelease, Distribution._dpkgstatus,
+                                                   '/etc/os-release',
+                                                   '/usr/lib/os-release'))
+
+
+# of the dpkg status database (often several MB) only the entry Proxmox detection needs is kept
+_DPKG_STATUS = Distribution._dpkgstatus.lstrip('/')
+_DPKG_PACKAGES = (b'Package: pve-manager',)
+
+
+def _dpkg_entries(f):
+    # the entries of _DPKG_PACKAGES in the dpkg status database f, read line by line
+    kept = []
+    keep = False
+    for line in f:
+        if line.startswith(b'Package: '):
+            keep = line.rstrip() in _DPKG_PACKAGES
+        if keep:
+            kept.append(line)
+    return b''.join(kept)
+
+
+def _norm(name):
+    return posixpath.normpath('/' + name).lstrip('/')
+
+
+def _apply_layer(layer, files):
+    # applies the release files of one layer (a tarfile) on top of files (path -> (type, data))
+    for m in layer:
+        name = _norm(m.name)
+        d, b = posixpath.split(name)
+        if b.startswith('.wh.'):  # whiteouts of overlay based images
+            if b == '.wh..wh..opq':
+                gone = d
+            else:
+                gone = posixpath.join(d, b[len('.wh.'):])
+            for f in list(files):
+                if f == gone or f.startswith(gone + '/'):
+                    del files[f]
+            continue
+        if name not in _RELEASE_FILES:
+            continue
+        if m.issym():
+            files[name] = ('link', m.linkname)
+        elif m.islnk():
+            target = files.get(_norm(m.linkname))
+            if target is not None:
+                files[name] = target
+        elif m.isfile():
+            f = layer.extractfile(m)
+            files[name] = ('file', _dpkg_entries(f) if name == _DPKG_STATUS else f.read())
+            f.close()
+
+
+def read_image_files(path):
+    # reads the release files out of an image tarball without extracting it
+    # either a "docker save" archive (manifest.json + layers), or a plain root file system tar
+    files = {}
+    with tarfile.open(path) as tf:
+        try:
+            manifest = tf.extractfile('manifest.json')
+        except KeyError:
+            manifest = None
+        if manifest is None:
+            _apply_layer(tf, files)
+            return files
+
+        layers = json.loads(manifest.read().decode('utf-8'))[0]['Layers']
+        for layer in layers:
+            f = tf.extractfile(layer)
+            lt = tarfile.open(fileobj=f, mode='r|*')  # streaming, layers might be compressed
+            _apply_layer(lt, files)
+            lt.close()
+    return files
+
+
+class ImageDistribution(LinbitDistribution):
+    # LinbitDistribution working on the files returned by read_image_files
+
+    def __init__(self, files, image, osreleasepath='/etc/os-release'):
+        self._files = files
+        super(ImageDistribution, self).__init__(osreleasepath, root=image)
+
+    def _lookup(self, path):
+        p = _norm(path)
+        for _ in range(8):
+            e = self._files.get(p)
+            if e is None or e[0] != 'link':
+                return e
+            target = e[1]
+            if not target.startswith('/'):
+                target = posixpath.join(posixpath.dirname(p), target)
+            p = _norm(target)
+        return None
+
+    def _exists(self, path):
+        self._counts['stat'] += 1
+        return self._lookup(path) is not None
+
+    def _open(self, path, mode='r'):
+        self._counts['read'] += 1
+        e = self._lookup(path)
+        if e is None:
+            raise IOError('No such file in image {0}: {1}'.format(self._root, path))
+        if 'b' in mode:
+            return io.BytesIO(e[1])
+        return io.StringIO(e[1].decode('utf-8'))
+
+
+def detect_image(path):
+    # path might be an unpacked root file system or an image tarball
+    if os.path.isdir(path):
+        return LinbitDistribution(root=path)
+    return ImageDistribution(read_image_files(path), path)
+
+
+def _detect_record(path):
+    # runs in the worker processes, only send back what is needed
+    try:
+        d = detect_image(path)
+        return path, (d.repo_name, d.name, d.version, d.family), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def detect_images(paths, jobs=None):
+    # yields (path, (repo_name, name, version, family), error) in the order of paths
+    # detection is spread over a pool of jobs processes (default: number of CPUs)
+    if jobs == 1:
+        for p in paths:
+            yield _detect_record(p)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for r in pool.imap(_detect_record, paths, chunksize=16):
+            yield r
+    finally:
+        pool.terminate()
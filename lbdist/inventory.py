@@ -0,0 +1,106 @@
+import array
+import sys
+from collections import Counter
+
+# Detection results of many nodes, stored column wise
+#
+# Every distinct value of a column is stored once, rows only hold its code in an array of small integers. A row
+# costs a few bytes per column (plus the node id if given) instead of a Distribution with its os-release dict.
+
+COLUMNS = ('repo_name', 'name', 'version', 'family')
+
+
+def _get(d, attr):
+    # None for what is not detectable (e.g., the version of a Proxmox root file system), or not there at all
+    try:
+        return getattr(d, attr, None)
+    except Exception:
+        return None
+
+
+class _Column(object):
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+        self.rows = array.array('H')
+
+    def code(self, value):
+        c = self.codes.get(value)
+        if c is None:
+            c = self.codes[value] = len(self.values)
+            self.values.append(value)
+            if c > 0xffff and self.rows.typecode == 'H':
+                self.rows = array.array('I', self.rows)
+        return c
+
+    def append(self, value):
+        self.rows.append(self.code(value))
+
+    def memory(self):
+        n = sys.getsizeof(self.values) + sys.getsizeof(self.codes) + sys.getsizeof(self.rows)
+        return n + sum(sys.getsizeof(v) for v in self.values)
+
+
+class Inventory(object):
+    def __init__(self):
+        self._columns = dict((c, _Column()) for c in COLUMNS)
+        self._nodes = []
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def add(self, d, node=None):
+        # d: a Distribution or LinbitDistribution, only what is in COLUMNS is kept
+        self.add_values([_get(d, c) for c in COLUMNS], node)
+
+    def add_values(self, values, node=None):
+        # values in the order of COLUMNS, like lbdist.images.detect_images yields them
+        for c, v in zip(COLUMNS, values):
+            self._columns[c].append(v)
+        self._nodes.append(node)
+
+    def __iter__(self):
+        # (node, repo_name, name, version, family) per row
+        columns = [self._columns[c] for c in COLUMNS]
+        for i, node in enumerate(self._nodes):
+            yield (node,) + tuple(c.values[c.rows[i]] for c in columns)
+
+    def _rows(self, where):
+        # indices of the rows matching all column=value pairs of where, None if there is no restriction
+        rows = None
+        for c, v in where.items():
+            col = self._columns[c]
+            code = col.codes.get(v)
+            if code is None:
+                return []
+            if rows is None:
+                rows = [i for i, x in enumerate(col.rows) if x == code]
+            else:
+                rows = [i for i in rows if col.rows[i] == code]
+        return rows
+
+    def count_by(self, *columns, **where):
+        # number of nodes per value of columns (a tuple of values for more than one column)
+        # where: only count nodes with these column values, e.g., count_by('repo_name', family='rhel')
+        rows = self._rows(where)
+        cols = [self._columns[c] for c in columns]
+        codes = [c.rows if rows is None else [c.rows[i] for i in rows] for c in cols]
+        counts = Counter(codes[0] if len(codes) == 1 else zip(*codes))
+
+        if len(cols) == 1:
+            return dict((cols[0].values[k], n) for k, n in counts.items())
+        return dict((tuple(c.values[x] for c, x in zip(cols, k)), n) for k, n in counts.items())
+
+    def group_by(self, column, **where):
+        # node ids per value of column
+        col = self._columns[column]
+        rows = self._rows(where)
+        groups = {}
+        for i in range(len(self._nodes)) if rows is None else rows:
+            groups.setdefault(col.values[col.rows[i]], []).append(self._nodes[i])
+        return groups
+
+    def memory(self):
+        # approximate number of bytes used, node ids included
+        n = sys.getsizeof(self._nodes) + sum(c.memory() for c in self._columns.values())
+        return n + sum(sys.getsizeof(node) for node in set(self._nodes) if node is not None)
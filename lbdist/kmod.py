@@ -0,0 +1,528 @@
+import os
+import struct
+
+# names best_drbd_kmod knows how to handle
+# keep as startswith, which allows forcing rhel by setting the family as name
+_KMOD_DISTS = ('rhel', 'centos', 'almalinux', 'rocky', 'sles')
+
+
+def kmod_dist_supported(name):
+    return name.startswith(_KMOD_DISTS)
+
+
+def split_host_kernel(hostkernel):
+    hostkernelsplit = hostkernel.replace('-', '.')
+    hostkernelsplit = hostkernelsplit.split('.')[::-1]
+    # strip x86, -default,... from the end
+    for i, e in enumerate(hostkernelsplit):
+        if e.isdigit():
+            hostkernelsplit = hostkernelsplit[i:][::-1]
+            break
+    return hostkernelsplit
+
+
+def parse_kmod(choice, sles=False):
+    # returns the numeric parts of the kernel version a kmod package was built for,
+    # the first 3 are the kernel, the rest the distribution specific release
+    # None if this is not a kmod package we understand
+    kpart = os.path.basename(choice)
+    if not (kpart.startswith('kmod-drbd') or kpart.startswith('drbd-kmp')):
+        return None
+    kpart = '_'.join(kpart.split('_')[1:])  # strip kmod-drbd-x.y.z_ prefix
+    if sles and kpart.startswith('k'):  # strip k from k4.12.14_197.29-1
+        kpart = kpart[1:]
+
+    kpart = kpart.split('-')[0]  # strip revision and everything past it
+    # convert the '_' in 3.10.0_1062,
+    # but only the first one as in 4.18.0_80.1.2.el8_0.x86_64
+    kpart = kpart.replace('_', '.', 1)
+
+    kps = kpart.split('.')
+    # the weird stuff should now be at the end of the array (arch, el*)
+    kps = [a for a in kps if a.isdigit()]
+    if len(kps) < 3:  # first 3 are the kernel
+        return None
+    return kps
+
+
+class KernelRelease(object):
+    # the numeric parts of a (distribution specific part of a) kernel release, parsed once
+    # ordered like the tuple of the parts, distance() gives the order relative to a host kernel
+    __slots__ = ('parts',)
+
+    def __init__(self, parts):
+        self.parts = tuple(int(p) for p in parts)
+
+    @classmethod
+    def host(cls, hks):
+        # host parts might contain garbage (el8 in 4.18.0-80.el8.1), we can only compare numbers
+        return cls(p for p in hks if isinstance(p, int) or p.isdigit())
+
+    def __repr__(self):
+        return 'KernelRelease({0!r})'.format('.'.join(str(p) for p in self.parts))
+
+    def __hash__(self):
+        return hash(self.parts)
+
+    def __eq__(self, other):
+        if not isinstance(other, KernelRelease):
+            return NotImplemented
+        return self.parts == other.parts
+
+    def __ne__(self, other):
+        if not isinstance(other, KernelRelease):
+            return NotImplemented
+        return self.parts != other.parts
+
+    def __lt__(self, other):
+        if not isinstance(other, KernelRelease):
+            return NotImplemented
+        return self.parts < other.parts
+
+    def __le__(self, other):
+        if not isinstance(other, KernelRelease):
+            return NotImplemented
+        return self.parts <= other.parts
+
+    def __gt__(self, other):
+        if not isinstance(other, KernelRelease):
+            return NotImplemented
+        return self.parts > other.parts
+
+    def __ge__(self, other):
+        if not isinstance(other, KernelRelease):
+            return NotImplemented
+        return self.parts >= other.parts
+
+    def distance(self, host, width):
+        # sort key, smaller is closer to host, missing parts count as 0, width is the number of parts to compare
+        # per part: not above the host part (the smaller the difference the better) beats above it (the smaller
+        # the difference the better)
+        key = []
+        hp, vp = host.parts, self.parts
+        for i in range(width):
+            d = (hp[i] if i < len(hp) else 0) - (vp[i] if i < len(vp) else 0)
+            key.append((0, d) if d >= 0 else (1, -d))
+        return tuple(key)
+
+
+# kmods starting with 'k' (k4.12.14_197.29) parse differently for SLES, so there might be one record per mode
+_MODE_OTHER = 1
+_MODE_SLES = 2
+_MODE_ALL = _MODE_OTHER | _MODE_SLES
+
+
+def _mode(name):
+    return _MODE_SLES if name.startswith('sles') else _MODE_OTHER
+
+
+def _index_entries(choices):
+    for c in choices:
+        other = parse_kmod(c, sles=False)
+        sles = parse_kmod(c, sles=True)
+        if other is not None and other == sles:
+            yield other, _MODE_ALL, c
+            continue
+        if other is not None:
+            yield other, _MODE_OTHER, c
+        if sles is not None:
+            yield sles, _MODE_SLES, c
+
+
+def _ranked(entries, host, mode, k=None):
+    # entries are (mode, KernelRelease, file) for the host kernel (first 3 parts), in input order
+    # host is the KernelRelease of the rest of the host kernel
+    # returns up to k (None: all) files, best first, for equally good ones the first one wins
+    import heapq
+
+    files, releases = {}, []
+    for emode, release, c in entries:
+        if not emode & mode:
+            continue
+        if release not in files:
+            releases.append(release)
+        files[release] = c  # last one with the same release wins
+
+    width = max([len(host.parts)] + [len(r.parts) for r in releases])
+
+    def key(r):
+        return r.distance(host, width)
+
+    if k is None:
+        ranked = sorted(releases, key=key)
+    else:
+        ranked = heapq.nsmallest(k, releases, key=key)  # stable, like sorted()[:k]
+    return [files[r] for r in ranked]
+
+
+def top_kmods(choices, name, hostkernel, k=None):
+    # ranks kmod packages for the host kernel, see LinbitDistribution.top_drbd_kmods
+    if not kmod_dist_supported(name):
+        return []
+
+    hks = split_host_kernel(hostkernel)
+    sles = name.startswith('sles')
+
+    def entries():
+        for c in choices:
+            kps = parse_kmod(c, sles)
+            if kps is None or kps[:3] != hks[:3]:
+                continue
+            yield _MODE_ALL, KernelRelease(kps[3:]), c
+
+    return _ranked(entries(), KernelRelease.host(hks[3:]), _MODE_ALL, k)
+
+
+class KmodCandidates(object):
+    # in memory counterpart of KmodIndex: parses the candidates once and answers many queries
+    # key: sort key for the files, by default they are kept in input order (add() appends)
+    # add()/remove() replace the lists per kernel instead of modifying them, queries running at the same time
+    # see either the old or the new state
+
+    def __init__(self, choices=(), key=None):
+        self._key = key
+        self._kernels = {}
+        for kps, mode, c in _index_entries(choices):
+            self._kernels.setdefault(tuple(kps[:3]), []).append((mode, KernelRelease(kps[3:]), c))
+        if key is not None:
+            for entries in self._kernels.values():
+                entries.sort(key=lambda e: key(e[2]))  # stable, keeps records of the same file together
+
+    def __len__(self):
+        return sum(len(v) for v in self._kernels.values())
+
+    def add(self, choice):
+        from bisect import bisect_right
+        for kps, mode, c in _index_entries([choice]):
+            kernel = tuple(kps[:3])
+            entries = list(self._kernels.get(kernel, ()))
+            pos = len(entries)
+            if self._key is not None:
+                pos = bisect_right([self._key(e[2]) for e in entries], self._key(c))
+            entries.insert(pos, (mode, KernelRelease(kps[3:]), c))
+            self._kernels[kernel] = entries
+
+    def remove(self, choice):
+        for kps, _, _ in _index_entries([choice]):
+            kernel = tuple(kps[:3])
+            entries = [e for e in self._kernels.get(kernel, ()) if e[2] != choice]
+            if entries:
+                self._kernels[kernel] = entries
+            else:
+                self._kernels.pop(kernel, None)
+
+    def _records(self):
+        # (kernel, mode, release parts, file), in order per kernel
+        for kernel, entries in list(self._kernels.items()):
+            for mode, release, c in entries:
+                yield kernel, mode, release.parts, c
+
+    def best(self, name, hostkernel):
+        best = self.top(name, hostkernel, 1)
+        return best[0] if best else None
+
+    def top(self, name, hostkernel, k=None):
+        if not kmod_dist_supported(name):
+            return []
+
+        hks = split_host_kernel(hostkernel)
+        entries = self._kernels.get(tuple(hks[:3]))
+        if not entries:
+            return []
+        return _ranked(entries, KernelRelease.host(hks[3:]), _mode(name), k)
+
+
+# LINBIT repository directories (rhel8.6, sles15-sp1, ...), see LinbitDistribution.repo_name
+# compiled on first use, importing re is not free
+_REPO_DIR = None
+
+
+def _repo_dir_match(d):
+    global _REPO_DIR
+    if _REPO_DIR is None:
+        import re
+        _REPO_DIR = re.compile(r'^(rhel|sles|amazonlinux|xenserver|ol|proxmox-)(\d+)(?:[.-]|$)')
+    return _REPO_DIR.match(d)
+
+
+def _repo_key(repo):
+    # (distribution, major) of a repository name, major might be None
+    if repo.startswith(('centos', 'almalinux', 'rocky')):
+        repo = 'rhel'
+    m = _repo_dir_match(repo)
+    if m:
+        return m.group(1), m.group(2)
+    for d in ('rhel', 'sles'):
+        if repo.startswith(d):
+            return d, None
+    return repo, None
+
+
+def _pruned(d, want):
+    # if the directory d can not contain kmods for want (see _repo_key)
+    if want is None:
+        return False
+    m = _repo_dir_match(d)
+    return bool(m and (m.group(1) != want[0] or (want[1] is not None and m.group(2) != want[1])))
+
+
+def _is_kmod_file(f):
+    return f.startswith('kmod-drbd') or f.startswith('drbd-kmp')
+
+
+def scan_kmods(root, target=None):
+    # lazily walks a repository tree and yields the paths of kmod packages
+    # if target is given (a repo name like rhel8.6 or a name like centos) directories of repositories that can not
+    # contain a matching kmod are not entered: other distributions, other major versions
+    # e.g., sles15-sp0 is still scanned for sles15-sp1, the kmods might be compatible
+    want = _repo_key(target) if target else None
+    for dirpath, dirnames, filenames in os.walk(root):
+        if want is not None:
+            dirnames[:] = [d for d in dirnames if not _pruned(d, want)]  # prune in place, os.walk is top down
+        dirnames.sort()
+        for f in sorted(filenames):
+            if _is_kmod_file(f):
+                yield os.path.join(dirpath, f)
+
+
+def _open_compressed(path):
+    # binary file object, decompressed on the fly according to the extension
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    if path.endswith('.xz'):
+        import lzma
+        return lzma.open(path, 'rb')
+    if path.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]  # strip the XML namespace
+
+
+def _primary_path(repo):
+    # the primary metadata file of an RPM repository, as listed in repomd.xml
+    from xml.etree.ElementTree import parse
+    repodata = os.path.join(repo, 'repodata')
+    try:
+        repomd = parse(os.path.join(repodata, 'repomd.xml')).getroot()
+    except (IOError, OSError):
+        repomd = None
+    if repomd is not None:
+        for data in repomd:
+            if _local_name(data.tag) == 'data' and data.get('type') == 'primary':
+                for e in data:
+                    if _local_name(e.tag) == 'location':
+                        return os.path.join(repo, e.get('href'))
+    for f in sorted(os.listdir(repodata)):
+        if '-primary.xml' in f or f.startswith('primary.xml'):
+            return os.path.join(repodata, f)
+    raise Exception('No primary metadata in {0}'.format(repodata))
+
+
+def primary_kmods(path):
+    # yields the locations (relative to the repository) of the kmod packages in a primary.xml(.gz,.xz,...)
+    # parsed incrementally, every package element is dropped once it was looked at
+    from xml.etree.ElementTree import iterparse
+    with _open_compressed(path) as f:
+        root = None
+        for event, e in iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = e
+            if event != 'end' or _local_name(e.tag) != 'package':
+                continue
+            name, href = None, None
+            for c in e:
+                tag = _local_name(c.tag)
+                if tag == 'name':
+                    name = c.text or ''
+                elif tag == 'location':
+                    href = c.get('href')
+            if name and _is_kmod_file(name) and href:
+                yield href
+            root.clear()  # also drops e
+
+
+def packages_kmods(path):
+    # yields the file names (relative to the archive root) of the kmod packages in a Debian style
+    # Packages(.gz,.xz,...) index, parsed stanza by stanza
+    with _open_compressed(path) as f:
+        fields = {}
+        for line in f:
+            line = line.rstrip()
+            if line:
+                if not line[:1].isspace():
+                    k, _, v = line.partition(b':')
+                    if k in (b'Package', b'Version', b'Architecture', b'Filename'):
+                        fields[k] = v.strip().decode('utf-8', 'replace')
+                continue
+            kmod = _packages_kmod(fields)
+            if kmod is not None:
+                yield kmod
+            fields = {}
+        kmod = _packages_kmod(fields)
+        if kmod is not None:
+            yield kmod
+
+
+def _packages_kmod(fields):
+    if not _is_kmod_file(fields.get(b'Package', '')):
+        return None
+    if b'Filename' in fields:
+        return fields[b'Filename']
+    return '{0}-{1}.{2}'.format(fields[b'Package'], fields.get(b'Version', ''), fields.get(b'Architecture', ''))
+
+
+def repo_kmods(src):
+    # kmod candidates from repository metadata, no packages need to be there
+    # src: an RPM repository (directory with repodata/), a primary.xml file, or a Debian style Packages file
+    if os.path.isdir(src):
+        return primary_kmods(_primary_path(src))
+    if 'primary.xml' in os.path.basename(src):
+        return primary_kmods(src)
+    return packages_kmods(src)
+
+
+def scan_order(root, path):
+    # sort key that orders the paths below root like scan_kmods yields them
+    parts = os.path.relpath(path, root).split(os.sep)
+    return tuple((1, d) for d in parts[:-1]) + ((0, parts[-1]),)
+
+
+# On disk kmod index
+#
+# Built once (e.g., when a repository gets published) and then queried via mmap. Layout:
+# header, fixed size records sorted by kernel (k1, k2, k3), the numeric release parts of all records, the file
+# names. Records for the same kernel keep the order of the input, so lookups give the same result as
+# best_drbd_kmod on the original list.
+_MAGIC = b'LBDKIDX1'
+_HEADER = struct.Struct('<8sIIII')  # magic, #records, offset records, offset release parts, offset names
+_RECORD = struct.Struct('<QQQBBHII')  # k1, k2, k3, mode, #release parts, len name, idx release parts, off name
+_PART = struct.Struct('<Q')
+
+
+def write_kmod_index(choices, path):
+    # choices: kmod files or a KmodCandidates (written without parsing again)
+    if isinstance(choices, KmodCandidates):
+        records = choices._records()
+    else:
+        records = ((kps[:3], mode, kps[3:], c) for kps, mode, c in _index_entries(choices))
+
+    entries = []
+    for kernel, mode, rest, c in records:
+        entries.append((tuple(int(k) for k in kernel), mode, [int(p) for p in rest], c.encode('utf-8')))
+    entries.sort(key=lambda e: e[0])  # stable, keeps input order per kernel
+
+    records, parts, names = [], [], []
+    nparts, nameoff = 0, 0
+    for kernel, mode, rest, c in entries:
+        if len(c) > 0xffff:
+            raise Exception('kmod file name too long for a kmod index ({0} bytes): {1}...'.format(
+                len(c), c[:64].decode('utf-8', 'replace')))
+        records.append(_RECORD.pack(kernel[0], kernel[1], kernel[2], mode, len(rest), len(c), nparts, nameoff))
+        parts.extend(rest)
+        names.append(c)
+        nparts += len(rest)
+        nameoff += len(c)
+
+    roff = _HEADER.size
+    poff = roff + len(records) * _RECORD.size
+    noff = poff + len(parts) * _PART.size
+
+    # write to a temporary file of our own and rename, readers might have the old one mapped and other writers
+    # (e.g., --watch and a manual --write-kmod-index) might be at it at the same time
+    import tempfile
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, len(records), roff, poff, noff))
+            f.write(b''.join(records))
+            f.write(struct.pack('<{0}Q'.format(len(parts)), *parts))
+            f.write(b''.join(names))
+        os.chmod(tmp, 0o644)  # mkstemp files are private, an index is for everyone that can read the repo
+        os.rename(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def is_kmod_index(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(_MAGIC)) == _MAGIC
+    except (IOError, OSError):
+        return False
+
+
+class _Kernels(object):
+    # sequence view on the (k1, k2, k3) of the records, good enough for bisect
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return self._index._n
+
+    def __getitem__(self, i):
+        return self._index._record(i)[:3]
+
+
+class KmodIndex(object):
+    def __init__(self, path):
+        import mmap
+        self._path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                raise Exception('{0} is not a kmod index'.format(path))
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._n, self._roff, self._poff, self._noff = _HEADER.unpack_from(self._buf, 0)
+        if magic != _MAGIC:
+            self.close()
+            raise Exception('{0} is not a kmod index'.format(path))
+
+    def close(self):
+        self._buf.close()
+
+    def __len__(self):
+        return self._n
+
+    def _record(self, i):
+        return _RECORD.unpack_from(self._buf, self._roff + i * _RECORD.size)
+
+    def _parts(self, idx, n):
+        return struct.unpack_from('<{0}Q'.format(n), self._buf, self._poff + idx * _PART.size)
+
+    def _name(self, off, n):
+        return self._buf[self._noff + off:self._noff + off + n].decode('utf-8')
+
+    def best(self, name, hostkernel):
+        best = self.top(name, hostkernel, 1)
+        return best[0] if best else None
+
+    def top(self, name, hostkernel, k=None):
+        if not kmod_dist_supported(name):
+            return []
+
+        hks = split_host_kernel(hostkernel)
+        try:
+            kernel = tuple(int(p) for p in hks[:3])
+        except ValueError:
+            return []
+
+        from bisect import bisect_left, bisect_right
+        kernels = _Kernels(self)
+        lo = bisect_left(kernels, kernel)
+        hi = bisect_right(kernels, kernel, lo)
+
+        ranked = _ranked(self._entries(lo, hi), KernelRelease.host(hks[3:]), _mode(name), k)
+        return [self._name(*r) for r in ranked]
+
+    def _entries(self, lo, hi):
+        for i in range(lo, hi):
+            _, _, _, mode, nparts, nlen, pidx, noff = self._record(i)
+            yield mode, KernelRelease(self._parts(pidx, nparts)), (noff, nlen)
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+
+from .kmod import KmodIndex, is_kmod_index, scan_kmods, write_kmod_index
+
+# Compatibility matrix: the kmod best_drbd_kmod picks for every (repo, kernel) cell
+#
+# The candidates are parsed once per repo (once overall for a plain list) into a kmod index in a temporary
+# directory, the worker processes only mmap these and look up their cells.
+
+_indexes = {}  # per process: index path -> KmodIndex
+
+
+def _cells(task):
+    # runs in the worker processes
+    path, name, kernels = task
+    index = _indexes.get(path)
+    if index is None:
+        index = _indexes[path] = KmodIndex(path)
+    return [(name, k, index.best(name, k)) for k in kernels]
+
+
+def _tasks(names, kernels, kmods, kmodsdir, tmpdir, chunksize):
+    shared = None
+    if kmods is not None:
+        if len(kmods) == 1 and is_kmod_index(kmods[0]):
+            shared = kmods[0]
+        else:
+            shared = os.path.join(tmpdir, 'all.idx')
+            write_kmod_index(kmods, shared)
+
+    for i, name in enumerate(names):
+        path = shared
+        if path is None:
+            path = os.path.join(tmpdir, '{0}.idx'.format(i))
+            write_kmod_index(scan_kmods(kmodsdir, name), path)
+        for start in range(0, len(kernels), chunksize):
+            yield path, name, kernels[start:start + chunksize]
+
+
+def kmod_matrix(names, kernels, kmods=None, kmodsdir=None, jobs=None, chunksize=64):
+    # yields (name, kernel, kmod) for every name (e.g., a repo name like rhel8.6) and kernel release
+    # kmod is None where there is no compatible kmod, the order is the one of names and kernels
+    # candidates are either a list of kmods (like "-k", might be a single kmod index) or a repository tree
+    # kmodsdir that gets scanned for every name (like "--kmods-dir")
+    # lookups are spread over a pool of jobs processes (default: number of CPUs)
+    if (kmods is None) == (kmodsdir is None):
+        raise Exception('Either kmods or kmodsdir has to be given')
+    kernels = list(kernels)
+
+    tmpdir = tempfile.mkdtemp(prefix='lbdist-matrix-')
+    pool = None
+    try:
+        tasks = _tasks(names, kernels, kmods, kmodsdir, tmpdir, chunksize)
+        if jobs == 1:
+            results = (_cells(t) for t in tasks)
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs)
+            results = pool.imap(_cells, tasks)
+        for cells in results:
+            for c in cells:
+                yield c
+    finally:
+        if pool is not None:
+            pool.terminate()
+        for path in list(_indexes):  # only opened here if jobs == 1
+            _indexes.pop(path).close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
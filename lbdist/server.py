@@ -0,0 +1,185 @@
+import json
+import os
+import socket
+import stat
+import threading
+
+from collections import OrderedDict
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from .distribution import LinbitDistribution
+from .cache import _key
+from .kmod import KmodCandidates, KmodIndex, is_kmod_index, scan_kmods
+
+# Protocol: one JSON object per line in both directions
+# request: {"query": "repo_name"|"name"|"version"|"family"|"all"|"epilogue"|"kmod", "osrelease": ..., "root": ...}
+#   "kmod" additionally takes "kmods" (list like lbdisttool.py -k) or "kmodsdir", "name", and "kernel"
+# response: {"result": ...} or {"error": "..."}
+
+
+class ServerError(Exception):
+    pass
+
+
+class _Lru(object):
+    # keeps the size most recently used entries
+    def __init__(self, size):
+        self._size = size
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        v = self._entries.pop(key, None)
+        if v is not None:
+            self._entries[key] = v
+        return v
+
+    def __setitem__(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Lbdistd(object):
+    # the state of the server: detection results and parsed kmod candidates
+    # both are bounded, every package upgrade or client asking for other files adds entries
+    MAX_DISTS = 64
+    MAX_CANDIDATES = 16
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dists = _Lru(self.MAX_DISTS)
+        self._candidates = _Lru(self.MAX_CANDIDATES)
+        self._watched = {}  # kmodsdir -> candidates kept up to date, never dropped
+
+    def dist(self, osreleasepath='/etc/os-release', root=None):
+        # keyed like the on disk cache, so package upgrades are noticed
+        key = _key(osreleasepath, root)
+        with self._lock:
+            d = self._dists.get(key)
+            if d is None:
+                d = LinbitDistribution(osreleasepath, root)
+                self._dists[key] = d
+        return d
+
+    def candidates(self, kmods=None, kmodsdir=None):
+        # paths are made absolute (clients send them that way, see lbdisttool.py), results of a kmodsdir are
+        # paths below the absolute kmodsdir
+        # a kmod index is keyed on its inode and mtime, so a republished index gets opened again
+        index = None
+        if kmodsdir:
+            kmodsdir = os.path.abspath(kmodsdir)
+            key = ('dir', kmodsdir)
+        elif kmods and len(kmods) == 1 and is_kmod_index(kmods[0]):
+            index = os.path.abspath(kmods[0])
+            st = os.stat(index)
+            key = ('index', index, st.st_ino, st.st_mtime)
+        else:
+            key = ('list', tuple(kmods or ()))
+        with self._lock:
+            c = self._watched.get(kmodsdir) if kmodsdir else None
+            if c is None:
+                c = self._candidates.get(key)
+            if c is None:
+                if kmodsdir:
+                    c = KmodCandidates(scan_kmods(kmodsdir))
+                elif index:
+                    c = KmodIndex(index)
+                else:
+                    c = KmodCandidates(key[1])
+                self._candidates[key] = c
+        return c
+
+    def watch(self, kmodsdir):
+        # keeps the candidates of kmodsdir up to date in the background, see lbdist.watch
+        from .watch import KmodWatcher
+        kmodsdir = os.path.abspath(kmodsdir)
+        watcher = KmodWatcher(kmodsdir)
+        with self._lock:
+            self._watched[kmodsdir] = watcher.candidates
+        t = threading.Thread(target=watcher.run)
+        t.daemon = True
+        t.start()
+        return watcher
+
+    def answer(self, req):
+        q = req.get('query')
+        osreleasepath = req.get('osrelease') or '/etc/os-release'
+        root = req.get('root')
+        if q == 'kmod':
+            name = req.get('name') or self.dist(osreleasepath, root).name
+            return LinbitDistribution.best_drbd_kmod(self.candidates(req.get('kmods'), req.get('kmodsdir')),
+                                                     name=name, hostkernel=req.get('kernel'))
+
+        d = self.dist(osreleasepath, root)
+        if q in ('repo_name', 'name', 'version', 'family'):
+            return getattr(d, q)
+        elif q == 'all':
+            return [d.repo_name, d.name, d.version, d.family]
+        elif q == 'epilogue':
+            return d.epilogue(with_pacemaker=bool(req.get('with_pacemaker')))
+        raise Exception('Unknown query: {0}'.format(q))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                resp = {'result': self.server.lbdistd.answer(json.loads(line.decode('utf-8')))}
+            except Exception as e:
+                resp = {'error': str(e)}
+            self.wfile.write((json.dumps(resp) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(path, lbdistd=None):
+    # a stale socket file gets replaced, anything else at path is left alone (binding fails then)
+    try:
+        if stat.S_ISSOCK(os.lstat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+    server = _Server(path, _Handler)
+    server.lbdistd = lbdistd or Lbdistd()
+    return server
+
+
+def serve(path, lbdistd=None):
+    # serves until interrupted
+    server = make_server(path, lbdistd)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def ask(path, req, timeout=5):
+    # socket errors (no server running,...) are raised as they are, errors of the server as ServerError
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall((json.dumps(req) + '\n').encode('utf-8'))
+        f = s.makefile('rb')
+        line = f.readline()
+        f.close()
+    finally:
+        s.close()
+    if not line:
+        raise socket.error('Connection closed by lbdist server')
+    resp = json.loads(line.decode('utf-8'))
+    if 'error' in resp:
+        raise ServerError(resp['error'])
+    return resp['result']
@@ -0,0 +1,225 @@
+import ctypes
+import errno
+import os
+import select
+import struct
+import sys
+
+from .kmod import KmodCandidates, _is_kmod_file, _pruned, _repo_key, scan_order, write_kmod_index
+
+# Keeps the kmod candidates of a repository tree up to date via Linux inotify (ctypes, no other dependencies)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; followed by the name
+
+
+def _fsencode(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding())
+
+
+def _fsdecode(name):
+    fsdecode = getattr(os, 'fsdecode', None)
+    return fsdecode(name) if fsdecode is not None else name
+
+
+class _Inotify(object):
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, 'inotify_init1: {0}'.format(os.strerror(e)))
+
+    def add_watch(self, path):
+        # returns the watch descriptor, None if path is gone or not a directory (any more)
+        wd = self._libc.inotify_add_watch(self.fd, _fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise OSError(e, 'inotify_add_watch {0}: {1}'.format(path, os.strerror(e)))
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)  # fails if the directory is already gone, that is fine
+
+    def read(self):
+        # all pending events as (wd, mask, name)
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            off = 0
+            while off < len(buf):
+                wd, mask, _, n = _EVENT.unpack_from(buf, off)
+                off += _EVENT.size
+                events.append((wd, mask, _fsdecode(buf[off:off + n].rstrip(b'\0'))))
+                off += n
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class KmodWatcher(object):
+    # candidates answers like KmodCandidates(scan_kmods(root, target)) of the current tree, also while a publish
+    # is in progress: files are added on close/rename, removed on delete/rename, directories are (un)watched
+    # as they come and go; if the kernel drops events the tree is scanned again
+    # indexpath: a kmod index file that is rewritten from candidates after every batch of changes
+
+    def __init__(self, root, target=None, indexpath=None):
+        self._root = root
+        self._want = _repo_key(target) if target else None
+        self._indexpath = indexpath
+        self._inotify = _Inotify()
+        self._dirs = {}  # watch descriptor -> directory
+        self._files = set()
+        try:
+            files = self._scan(root)
+        except Exception:
+            self.close()
+            raise
+        self._files.update(files)
+        self.candidates = KmodCandidates(files, key=self._order)
+        self._write_index()
+
+    def _order(self, path):
+        return scan_order(self._root, path)
+
+    def fileno(self):
+        return self._inotify.fd
+
+    def close(self):
+        self._inotify.close()
+
+    def _scan(self, top):
+        # watches top and the directories below, returns the kmods in there
+        # every directory is watched before it is listed, so nothing added meanwhile is missed
+        found = []
+        todo = [top]
+        while todo:
+            d = todo.pop()
+            wd = self._inotify.add_watch(d)
+            if wd is None:
+                continue
+            self._dirs[wd] = d
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for name in names:
+                p = os.path.join(d, name)
+                if os.path.isdir(p):
+                    if not os.path.islink(p) and not _pruned(name, self._want):  # like os.walk
+                        todo.append(p)
+                elif _is_kmod_file(name):
+                    found.append(p)
+        return found
+
+    def _add(self, path):
+        if path in self._files:
+            return False
+        self._files.add(path)
+        self.candidates.add(path)
+        return True
+
+    def _remove(self, path):
+        if path not in self._files:
+            return False
+        self._files.remove(path)
+        self.candidates.remove(path)
+        return True
+
+    def _forget(self, d):
+        # a directory was removed or moved away
+        prefix = d + os.sep
+        for wd, wdir in list(self._dirs.items()):
+            if wdir == d or wdir.startswith(prefix):
+                del self._dirs[wd]
+                self._inotify.rm_watch(wd)
+        changed = False
+        for f in [f for f in self._files if f.startswith(prefix)]:
+            changed = self._remove(f) or changed
+        return changed
+
+    def _rescan(self):
+        self._dirs = {}
+        files = self._scan(self._root)
+        self._files = set(files)
+        self.candidates._kernels = KmodCandidates(files, key=self._order)._kernels
+        return True
+
+    def _handle(self, wd, mask, name):
+        # returns if candidates changed
+        if mask & IN_Q_OVERFLOW:
+            return self._rescan()
+        if mask & IN_IGNORED:
+            self._dirs.pop(wd, None)
+            return False
+        d = self._dirs.get(wd)
+        if d is None or not name:
+            return False
+
+        path = os.path.join(d, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if _pruned(name, self._want):
+                    return False
+                changed = False
+                for f in self._scan(path):
+                    changed = self._add(f) or changed
+                return changed
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                return self._forget(path)
+            return False
+
+        if not _is_kmod_file(name):
+            return False
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            return self._add(path)
+        if mask & IN_CREATE and not os.path.isdir(path):
+            return self._add(path)  # candidates are names only, and hard links and symlinks are never written
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            return self._remove(path)
+        return False
+
+    def _write_index(self):
+        if self._indexpath:
+            write_kmod_index(self.candidates, self._indexpath)
+
+    def process(self, timeout=None):
+        # waits up to timeout seconds (None: forever) for changes and applies all pending ones
+        # returns the number of events
+        r, _, _ = select.select([self._inotify.fd], [], [], timeout)
+        if not r:
+            return 0
+        events = self._inotify.read()
+        changed = False
+        for wd, mask, name in events:
+            changed = self._handle(wd, mask, name) or changed
+        if changed:
+            self._write_index()
+        return len(events)
+
+    def run(self):
+        while True:
+            self.process()
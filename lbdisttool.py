@@ -2,15 +2,195 @@
 
 import argparse
 import lbdist
+import os
 import sys
 
+
+def batch_kmods(kmods, osrelease, root, name, kernel):
+    # JSON lines in, JSON lines out: {"name": ..., "kernel": ...} -> {"name": ..., "kernel": ..., "kmod": ...}
+    # missing fields default to --force-name/--force-kernel-release (or detection)
+    # queries that cannot be answered get an "error" instead of "kmod"
+    import json
+    if not isinstance(kmods, lbdist.KmodIndex):
+        kmods = lbdist.KmodCandidates(kmods)  # parse once
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('not a JSON object')
+            for field in ('name', 'kernel'):
+                if record.get(field) is not None and not isinstance(record[field], type(u'')):
+                    raise ValueError('"{0}" is not a string'.format(field))
+        except ValueError as e:
+            record = {'error': 'invalid query: {0}'.format(e)}
+        else:
+            try:
+                qname = record.get('name') or name
+                if not qname:
+                    name = qname = lbdist.LinbitDistribution(osrelease, root).name
+                record['kmod'] = lbdist.LinbitDistribution.best_drbd_kmod(kmods, name=qname,
+                                                                          hostkernel=record.get('kernel') or kernel)
+            except Exception as e:
+                record['error'] = str(e)
+        sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+        sys.stdout.flush()
+
+
+def timing(phase, seconds, error):
+    # tracer for --timings
+    outcome = 'ok' if error is None else 'failed: {0}'.format(error)
+    sys.stderr.write('{0}: {1:.6f}s {2}\n'.format(phase, seconds, outcome))
+
+
+def use_cache(args):
+    return args.cache or (args.cache is None and os.environ.get('LBDIST_CACHE') == '1')
+
+
+def dist(args):
+    tracer = timing if args.timings else None
+    probe = None
+    if args.epilogue:
+        # one pass over PATH and uname for epilogue, detection checks files in there (pveversion) from it
+        from lbdist.hostprobe import HostProbe
+        probe = HostProbe()
+        probe.scan()
+    if use_cache(args):
+        from lbdist.cache import cached_distribution
+        return cached_distribution(args.osrelease, args.root, tracer=tracer, probe=probe)
+    return lbdist.LinbitDistribution(args.osrelease, args.root, probe=probe, tracer=tracer)
+
+
+def query(args, q, local, **req):
+    # answers q via the lbdist server if one is configured and reachable, otherwise via local()
+    if args.socket:
+        import socket
+        import time
+        from lbdist.server import ask
+        # the server resolves paths relative to its own working directory
+        req.update(query=q, osrelease=os.path.abspath(args.osrelease), root=args.root and os.path.abspath(args.root))
+        kmods = req.get('kmods')
+        if kmods and len(kmods) == 1 and lbdist.kmod.is_kmod_index(kmods[0]):
+            req['kmods'] = [os.path.abspath(kmods[0])]  # other entries are kmod names, answered as given
+        kmodsdir = req.get('kmodsdir')
+        if kmodsdir:
+            req['kmodsdir'] = os.path.abspath(kmodsdir)
+        start = time.time() if args.timings else None
+        try:
+            ret = ask(args.socket, req)
+        except socket.error as e:
+            if args.timings:
+                timing('server', time.time() - start, e)
+        else:
+            if args.timings:
+                timing('server', time.time() - start, None)
+            if kmodsdir and ret and ret.startswith(req['kmodsdir'] + os.sep):
+                # below kmodsdir as given, like scan_kmods returns them locally
+                ret = os.path.join(kmodsdir, os.path.relpath(ret, req['kmodsdir']))
+            return ret
+    return local()
+
+
+def best_kmod(args, detected):
+    if args.root and not args.forcename and not args.kmodsdir:
+        args.forcename = detected().name
+    if args.kmodsdir:
+        target = args.forcename
+        if not target:
+            d = detected()
+            args.forcename, target = d.name, d.repo_name
+        kmods = lbdist.kmod.scan_kmods(args.kmodsdir, target)
+    else:
+        kmods = args.kmods
+        if len(kmods) == 1 and lbdist.kmod.is_kmod_index(kmods[0]):
+            kmods = lbdist.KmodIndex(kmods[0])
+    return lbdist.LinbitDistribution.best_drbd_kmod(kmods,
+                                                    osreleasepath=args.osrelease,
+                                                    name=args.forcename,
+                                                    hostkernel=args.forcekernelrelease)
+
+
+def join(v, fmt, keys):
+    out = ''
+    if fmt == 'csv':
+        out = ','.join(x or '' for x in v)
+    elif fmt == 'space':
+        out = ' '.join(x or '' for x in v)
+    elif fmt == 'json':
+        import json
+        out = json.dumps(dict(zip(keys, v)), sort_keys=True)
+    return out
+
+
+# what "-l", "-n", "--dist-version", "-f", "-k", and "-e" ask for, in output order ("-a" are the first four)
+FIELDS = ('repo_name', 'name', 'version', 'family', 'kmod', 'epilogue')
+DETECTED = FIELDS[:4]
+
+
+def answers(args, fields):
+    # values of fields, all from one detection pass (or from the lbdist server)
+    detection = []
+
+    def detected():
+        if not detection:
+            detection.append(dist(args))
+        return detection[0]
+
+    values = {}
+    wanted = [f for f in DETECTED if f in fields]
+    if len(wanted) == 1:
+        values[wanted[0]] = query(args, wanted[0], lambda: getattr(detected(), wanted[0]))
+    elif wanted:
+        def local():
+            d = detected()
+            return [getattr(d, f) if f in wanted else None for f in DETECTED]
+        values.update(zip(DETECTED, query(args, 'all', local)))
+    if 'kmod' in fields:
+        values['kmod'] = query(args, 'kmod', lambda: best_kmod(args, detected), kmods=args.kmods,
+                               kmodsdir=args.kmodsdir, name=args.forcename, kernel=args.forcekernelrelease)
+    if 'epilogue' in fields:
+        # the best module lookup is cached like detection results, only on request
+        cachedir = None if use_cache(args) else False
+
+        def epilogue():
+            d = detected()
+            text = d.epilogue(cachedir=cachedir)
+            probe = d._probe
+            if args.timings and probe is not None:
+                sys.stderr.write('probe: {0:.6f}s {1} listings, {2} checks, {3} saved checks\n'.format(
+                    probe.seconds, probe.listings, probe.checks, probe.saved_checks))
+            return text
+        values['epilogue'] = query(args, 'epilogue', epilogue)
+    return [values[f] for f in fields]
+
+
 parser = argparse.ArgumentParser(description='a uname like program to query distribution information')
 parser.add_argument('--os-release', dest='osrelease',
                     help='Path to the os-release file', default='/etc/os-release')
+parser.add_argument('--root', metavar='DIR',
+                    help='Detect the distribution of the root file system DIR instead of the host')
+parser.add_argument('--cache', action='store_true', default=None,
+                    help='Cache detection results and the best kernel module of "-e" across invocations '
+                    '(also enabled by LBDIST_CACHE=1)')
+parser.add_argument('--no-cache', action='store_false', dest='cache',
+                    help='Do not use the detection cache and the best kernel module cache of "-e"')
+parser.add_argument('--flush-cache', action='store_true', dest='flushcache',
+                    help='Remove all cached detection results')
+parser.add_argument('--serve', metavar='SOCKET',
+                    help='Serve queries on the Unix socket SOCKET. Kernel modules given via "-k" or "--kmods-dir" '
+                         'are parsed ahead of time')
+parser.add_argument('--socket', metavar='SOCKET', default=os.environ.get('LBDIST_SOCKET'),
+                    help='Ask the server on SOCKET (default: LBDIST_SOCKET), falls back to local queries')
 parser.add_argument('--force-name', dest='forcename',
                     help='Force distribution name. Only relvant for "-k"')
 parser.add_argument('--force-kernel-release', dest='forcekernelrelease',
                     help='Force kernel release (usually uname -r). Only relvant for "-k"')
+parser.add_argument('--batch', action='store_true',
+                    help='Read JSON lines with "name" and "kernel" from stdin and print the best kmod per line. '
+                         'Requires "-k"')
 parser.add_argument('--linbit-reponame', '-l', action='store_true', dest='lbrepo',
                     help='Query the LINBIT internal distribution name/repo name')
 parser.add_argument('--name', '-n', action='store_true', dest='name',
@@ -20,41 +200,115 @@ parser.add_argument('--dist-version', action='store_true', dest='distversion',
 parser.add_argument('--family', '-f', action='store_true', dest='family',
                     help='Query the distribution family')
 parser.add_argument('--kmods', '-k', metavar='M', nargs='+',
-                    help='Find the best matching kernel module')
+                    help='Find the best matching kernel module. M might also be a single kmod index file')
+parser.add_argument('--kmods-dir', dest='kmodsdir', metavar='DIR',
+                    help='Like "-k", but scan the repository tree DIR for kernel modules')
+parser.add_argument('--kmods-repo', dest='kmodsrepo', metavar='SRC', nargs='+',
+                    help='Like "-k", but take the kernel modules from repository metadata: an RPM repository '
+                         '(directory with repodata/), a primary.xml(.gz) or a Debian style Packages(.gz,.xz) file')
+parser.add_argument('--matrix', metavar='REPO', nargs='+',
+                    help='Print the best kmod of "-k" or "--kmods-dir" for every REPO (e.g., rhel9.2) and every '
+                         'kernel release read from stdin, an empty kmod marks a coverage gap')
+parser.add_argument('--write-kmod-index', dest='writekmodindex', metavar='FILE',
+                    help='Write the kernel modules given via "-k" or "--kmods-dir" to a kmod index file')
+parser.add_argument('--watch', action='store_true',
+                    help='Keep the kernel modules of "--kmods-dir" up to date via inotify, '
+                         'for "--serve" and "--write-kmod-index"')
 parser.add_argument('--linbit-epilogue', '-e', action='store_true', dest='epilogue',
                     help='Query the LINBIT internal pkg hints')
 parser.add_argument('--all', '-a', action='store_true', dest='all',
                     help='Query all information')
-parser.add_argument('--format', choices=('csv', 'space'), default='csv',
-                    help='Output format')
+parser.add_argument('--images', metavar='IMAGE', nargs='+',
+                    help='Query all information for every given unpacked root file system or image tarball, '
+                         'the path gets appended. "-" reads paths from stdin')
+parser.add_argument('--jobs', '-j', type=int,
+                    help='Number of processes for "--images" and "--matrix", defaults to the number of CPUs')
+parser.add_argument('--timings', action='store_true',
+                    help='Print how long every detection step took to stderr')
+parser.add_argument('--format', choices=('csv', 'space', 'json'), default='csv',
+                    help='Output format. Combined queries print their fields in the order of "-a", "-k", "-e", '
+                         'json prints one object per line. "-e" is combined with other queries in json only')
 
 args = parser.parse_args()
 
-if args.lbrepo:
-    print(lbdist.LinbitDistribution(args.osrelease).repo_name)
-elif args.name:
-    print(lbdist.LinbitDistribution(args.osrelease).name)
-elif args.distversion:
-    print(lbdist.LinbitDistribution(args.osrelease).version)
-elif args.family:
-    print(lbdist.LinbitDistribution(args.osrelease).family)
-elif args.kmods:
-    best = lbdist.LinbitDistribution.best_drbd_kmod(args.kmods,
-                                                    osreleasepath=args.osrelease,
-                                                    name=args.forcename,
-                                                    hostkernel=args.forcekernelrelease)
-    if best:
-        print(best)
+if args.kmodsrepo:
+    # only the kmod entries of the metadata are kept
+    args.kmods = (args.kmods or []) + [k for src in args.kmodsrepo for k in lbdist.kmod.repo_kmods(src)]
+
+if args.flushcache:
+    import lbdist.cache
+    lbdist.cache.flush_cache()
+
+if args.serve:
+    from lbdist.server import Lbdistd, serve
+    lbdistd = Lbdistd()
+    if args.kmodsdir and args.watch:
+        lbdistd.watch(args.kmodsdir)
+    elif args.kmods is not None or args.kmodsdir:
+        lbdistd.candidates(args.kmods, args.kmodsdir)
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # clean up the socket
+    try:
+        serve(args.serve, lbdistd)
+    except KeyboardInterrupt:
+        pass
+elif args.kmodsdir and args.writekmodindex and args.watch:
+    from lbdist.watch import KmodWatcher
+    try:
+        KmodWatcher(args.kmodsdir, indexpath=args.writekmodindex).run()
+    except KeyboardInterrupt:
+        pass
+elif args.kmodsdir and args.writekmodindex:
+    lbdist.write_kmod_index(lbdist.kmod.scan_kmods(args.kmodsdir), args.writekmodindex)
+elif args.kmods is not None and args.writekmodindex:
+    lbdist.write_kmod_index(args.kmods, args.writekmodindex)
+elif (args.kmods is not None or args.kmodsdir) and args.matrix:
+    from lbdist.matrix import kmod_matrix
+    kernels = [line.strip() for line in sys.stdin if line.strip()]
+    gaps = {}
+    for repo, kernel, kmod in kmod_matrix(args.matrix, kernels, args.kmods, args.kmodsdir, args.jobs):
+        print(join([repo, kernel, kmod], args.format, ('repo_name', 'kernel', 'kmod')))
+        if kmod is None:
+            gaps[repo] = gaps.get(repo, 0) + 1
+    for repo in args.matrix:
+        if repo in gaps:
+            sys.stderr.write('{0}: no kmod for {1} of {2} kernels\n'.format(repo, gaps[repo], len(kernels)))
+    if gaps:
+        sys.exit(1)
+elif (args.kmods is not None or args.kmodsdir) and args.batch:
+    if args.kmodsdir:
+        kmods = lbdist.kmod.scan_kmods(args.kmodsdir)
     else:
+        kmods = args.kmods
+        if len(kmods) == 1 and lbdist.kmod.is_kmod_index(kmods[0]):
+            kmods = lbdist.KmodIndex(kmods[0])
+    batch_kmods(kmods, args.osrelease, args.root, args.forcename, args.forcekernelrelease)
+elif args.images:
+    import lbdist.images
+    images = args.images
+    if images == ['-']:
+        images = (line.strip() for line in sys.stdin if line.strip())
+    failed = False
+    for image, v, err in lbdist.images.detect_images(images, args.jobs):
+        if err is not None:
+            sys.stderr.write('{0}: {1}\n'.format(image, err))
+            failed = True
+            continue
+        print(join(list(v) + [image], args.format, DETECTED + ('image',)))
+    if failed:
         sys.exit(1)
-elif args.epilogue:
-    print(lbdist.LinbitDistribution(args.osrelease).epilogue())
-elif args.all:
-    d = lbdist.LinbitDistribution(args.osrelease)
-    v = [d.repo_name, d.name, d.version, d.family]
-    out = ''
-    if args.format == 'csv':
-        out = ','.join(v)
-    elif args.format == 'space':
-        out = ' '.join(v)
-    print(out)
+else:
+    asked = {'repo_name': args.lbrepo or args.all, 'name': args.name or args.all,
+             'version': args.distversion or args.all, 'family': args.family or args.all,
+             'kmod': args.kmods is not None or args.kmodsdir, 'epilogue': args.epilogue}
+    fields = [f for f in FIELDS if asked[f]]
+    if 'epilogue' in fields and len(fields) > 1 and args.format != 'json':
+        # it spans lines and contains commas and spaces, nothing could split such a line again
+        parser.error('"-e" can only be combined with other queries in "--format json"')
+    if fields:
+        values = answers(args, fields)
+        best_missing = 'kmod' in fields and not values[fields.index('kmod')]
+        if fields != ['kmod'] or not best_missing:
+            print(join(values, args.format, fields))
+        if best_missing:
+            sys.exit(1)
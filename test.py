@@ -1,7 +1,39 @@
 #!/usr/bin/env python
 
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
-from lbdist.distribution import LinbitDistribution
+from lbdist.distribution import Distribution, LinbitDistribution
+from lbdist.bestmodule import fetch_best_module
+from lbdist.cache import cached_distribution, flush_cache
+from lbdist.hostprobe import HostProbe
+from lbdist.images import detect_image, detect_images, read_image_files
+from lbdist.inventory import Inventory
+from lbdist.matrix import kmod_matrix
+from lbdist.watch import KmodWatcher
+from lbdist.server import Lbdistd, ServerError, ask, make_server
+from lbdist.kmod import (KernelRelease, KmodCandidates, KmodIndex, write_kmod_index, is_kmod_index, repo_kmods,
+                         scan_kmods)
+
+KMODS = ['rhel8/kmod-drbd-9.0.25_4.18.0_80.1.2.el8_0.x86_64-1.x86_64.rpm',
+         'rhel8/kmod-drbd-9.0.25_4.18.0_80.el8.s390x-1.x86_64.rpm',
+         'rhel8/kmod-drbd-9.0.25_4.18.0_147.el8-1.x86_64.rpm',
+         'rhel8/kmod-drbd-9.0.25_4.18.0_193.el8-1.x86_64.rpm',
+         'rhel7/kmod-drbd-9.0.25_3.10.0_1062-1.x86_64.rpm',
+         'rhel7/kmod-drbd-9.0.25_3.10.0_1160-1.x86_64.rpm',
+         'sles15-sp0/drbd-kmp-default-9.0.24_k4.12.14_25.25-1.x86_64.rpm',
+         'sles15-sp1/drbd-kmp-default-9.0.24_k4.12.14_197.44-1.x86_64.rpm',
+         'sles15-sp1/drbd-kmp-default-9.0.24_k4.12.14_197.29-1.x86_64.rpm',
+         'drbd-utils-9.13.0-1.x86_64.rpm']
 
 
 class TestBestKernel(unittest.TestCase):
@@ -18,6 +50,981 @@ class TestBestKernel(unittest.TestCase):
                                               name='sles15-sp1', hostkernel='4.12.14.25')
         self.assertEqual(b, 'sles15-sp0/amd64/drbd-kmp-default-9.0.24_k4.12.14_25.25-1.x86_64.rpm')
 
+    def test_top(self):
+        kmods = ['kmod-drbd-9.1.0_4.18.0_{0}.el8-1.x86_64.rpm'.format(r) for r in ('80', '147', '193', '240', '305')]
+        top = LinbitDistribution.top_drbd_kmods(kmods, 3, name='rhel8', hostkernel='4.18.0-200.el8.x86_64')
+        self.assertEqual([k.split('_')[2] for k in top], ['193.el8-1.x86', '147.el8-1.x86', '80.el8-1.x86'])
+        self.assertEqual(len(LinbitDistribution.top_drbd_kmods(kmods, name='rhel8', hostkernel='4.18.0-200')), 5)
+        self.assertEqual(KmodCandidates(kmods).top('rhel8', '4.18.0-200', 3), top)
+        self.assertEqual(LinbitDistribution.top_drbd_kmods(kmods, 3, name='rhel9', hostkernel='5.14.0-70'), [])
+
+
+class TestKernelRelease(unittest.TestCase):
+    def test_order(self):
+        a, b, c = KernelRelease('80.1'.split('.')), KernelRelease([80, 1]), KernelRelease([80, 1, 0])
+        self.assertEqual(a, b)
+        self.assertEqual(len(set([a, b, c])), 2)
+        self.assertTrue(a < c < KernelRelease([81]))
+
+    def test_other_types(self):
+        a = KernelRelease([80, 1])
+        self.assertFalse(a == (80, 1))
+        self.assertTrue(a != (80, 1))
+        self.assertNotIn(None, [a])
+        if sys.version_info >= (3,):  # Python 2 falls back to an arbitrary order
+            self.assertRaises(TypeError, lambda: a < (81,))
+
+    def test_distance(self):
+        host = KernelRelease.host(['305', 'el8', '3'])
+        self.assertEqual(host.parts, (305, 3))
+        ranked = sorted([KernelRelease([r]) for r in (306, 240, 305, 400, 10)], key=lambda r: r.distance(host, 2))
+        self.assertEqual([r.parts[0] for r in ranked], [305, 240, 10, 306, 400])
+
+
+class TestKmodIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'kmods.idx')
+        write_kmod_index(KMODS, self.path)
+        self.index = KmodIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_is_index(self):
+        self.assertTrue(is_kmod_index(self.path))
+        self.assertFalse(is_kmod_index(__file__))
+        self.assertEqual(os.listdir(self.tmpdir), ['kmods.idx'])  # no temporary files left
+
+    def test_long_name(self):
+        kmod = 'rhel8/' + 'x' * 0x10000 + '/kmod-drbd-9.0.25_4.18.0_80.el8-1.x86_64.rpm'
+        with self.assertRaises(Exception) as cm:
+            write_kmod_index([kmod], self.path)
+        self.assertIn('too long', str(cm.exception))
+        self.assertEqual(self.index.best('rhel8.2', '4.18.0-180.el8.x86_64'),
+                         'rhel8/kmod-drbd-9.0.25_4.18.0_147.el8-1.x86_64.rpm')  # the old index is still there
+        self.assertEqual(os.listdir(self.tmpdir), ['kmods.idx'])
+
+    def test_same_as_list(self):
+        for name, kernel in (('rhel8.2', '4.18.0-80.el8.x86_64'), ('rhel8.2', '4.18.0-180.el8.x86_64'),
+                             ('rhel8.2', '4.18.0-240.el8.x86_64'), ('centos', '4.18.0'),
+                             ('rhel7.9', '3.10.0-1127.el7.x86_64'), ('sles15-sp1', '4.12.14.25'),
+                             ('sles15-sp1', '4.12.14-197.37-default'), ('sles15-sp1', '5.3.18-24-default'),
+                             ('ubuntu', '4.18.0')):
+            self.assertEqual(LinbitDistribution.best_drbd_kmod(self.index, name=name, hostkernel=kernel),
+                             LinbitDistribution.best_drbd_kmod(KMODS, name=name, hostkernel=kernel))
+
+    def test_lookup(self):
+        self.assertEqual(self.index.best('rhel8.2', '4.18.0-180.el8.x86_64'),
+                         'rhel8/kmod-drbd-9.0.25_4.18.0_147.el8-1.x86_64.rpm')
+        self.assertEqual(self.index.best('sles15-sp1', '4.12.14-197.37-default'),
+                         'sles15-sp1/drbd-kmp-default-9.0.24_k4.12.14_197.29-1.x86_64.rpm')
+        self.assertIsNone(self.index.best('rhel9.0', '5.14.0-70.el9.x86_64'))
+
+
+class TestBatch(unittest.TestCase):
+    QUERIES = [('rhel8.2', '4.18.0-80.el8.x86_64'), ('rhel8.2', '4.18.0-240.el8.x86_64'),
+               ('rhel7.9', '3.10.0-1127.el7.x86_64'), ('sles15-sp1', '4.12.14-197.37-default'),
+               ('sles15-sp1', '5.3.18-24-default'), ('debian', '4.19.0')]
+
+    def test_same_as_single(self):
+        expected = [LinbitDistribution.best_drbd_kmod(KMODS, name=n, hostkernel=k) for n, k in self.QUERIES]
+        self.assertEqual(list(LinbitDistribution.best_drbd_kmods(KMODS, self.QUERIES)), expected)
+        self.assertEqual(list(LinbitDistribution.best_drbd_kmods(KmodCandidates(KMODS), self.QUERIES)), expected)
+
+    def test_lazy(self):
+        def queries():
+            yield 'rhel8.2', '4.18.0-80.el8.x86_64'
+            raise AssertionError('consumed too early')
+
+        results = LinbitDistribution.best_drbd_kmods(KMODS, queries())
+        self.assertEqual(next(results), 'rhel8/kmod-drbd-9.0.25_4.18.0_80.el8.s390x-1.x86_64.rpm')
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for k in KMODS + ['sles12-sp5/drbd-kmp-default-9.0.24_k4.12.14_120-1.x86_64.rpm']:
+            d = os.path.join(self.tmpdir, os.path.dirname(k))
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            open(os.path.join(self.tmpdir, k), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def found(self, target=None):
+        return [os.path.relpath(k, self.tmpdir) for k in scan_kmods(self.tmpdir, target)]
+
+    def test_all(self):
+        self.assertEqual(len(self.found()), len(KMODS))  # -1 for drbd-utils, +1 for sles12
+
+    def test_prune(self):
+        self.assertEqual(sorted(set(os.path.dirname(k) for k in self.found('sles15-sp1'))),
+                         ['sles15-sp0', 'sles15-sp1'])
+        self.assertEqual(sorted(set(os.path.dirname(k) for k in self.found('centos'))), ['rhel7', 'rhel8'])
+        self.assertEqual(sorted(set(os.path.dirname(k) for k in self.found('rhel8.2'))), ['rhel8'])
+
+    def test_best(self):
+        b = LinbitDistribution.best_drbd_kmod(scan_kmods(self.tmpdir, 'sles15-sp1'),
+                                              name='sles15-sp1', hostkernel='4.12.14.25')
+        self.assertEqual(os.path.relpath(b, self.tmpdir),
+                         'sles15-sp0/drbd-kmp-default-9.0.24_k4.12.14_25.25-1.x86_64.rpm')
+
+    def test_matrix(self):
+        repos = ['rhel7.9', 'rhel8.2', 'sles15-sp1']
+        kernels = ['3.10.0-1160.el7.x86_64', '4.18.0-193.el8.x86_64', '4.12.14-197.44-default', '5.14.0-70.el9']
+        expected = [(r, k, LinbitDistribution.best_drbd_kmod(scan_kmods(self.tmpdir, r), name=r, hostkernel=k))
+                    for r in repos for k in kernels]
+        self.assertEqual(expected[1][2], None)
+        for jobs in (1, 2):
+            cells = list(kmod_matrix(repos, kernels, kmodsdir=self.tmpdir, jobs=jobs, chunksize=3))
+            self.assertEqual(cells, expected)
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+class TestWatch(unittest.TestCase):
+    QUERIES = [('rhel8.2', '4.18.0-180.el8.x86_64'), ('rhel7.9', '3.10.0-1127.el7.x86_64'),
+               ('sles15-sp1', '4.12.14-197.37-default'), ('rhel9.0', '5.14.0-70.el9.x86_64')]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        for k in KMODS:
+            self.touch(k)
+        self.index = os.path.join(self.tmpdir, 'kmods.idx')
+        self.watcher = KmodWatcher(self.repo, indexpath=self.index)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, k, top=None):
+        p = os.path.join(top or self.repo, k)
+        if not os.path.isdir(os.path.dirname(p)):
+            os.makedirs(os.path.dirname(p))
+        open(p, 'w').close()
+
+    def assertCurrent(self):
+        while self.watcher.process(0.05):
+            pass
+        fresh = KmodCandidates(scan_kmods(self.repo))
+        index = KmodIndex(self.index)
+        try:
+            for name, kernel in self.QUERIES:
+                self.assertEqual(self.watcher.candidates.top(name, kernel), fresh.top(name, kernel))
+                self.assertEqual(index.top(name, kernel), fresh.top(name, kernel))
+        finally:
+            index.close()
+
+    def test_changes(self):
+        self.assertCurrent()
+        self.touch('rhel8/kmod-drbd-9.0.25_4.18.0_148.el8-1.x86_64.rpm')
+        self.touch('rhel8/a/kmod-drbd-9.0.25_4.18.0_147.el8-1.x86_64.rpm')
+        os.remove(os.path.join(self.repo, KMODS[3]))
+        self.assertCurrent()
+
+        # a publish: new directory filled elsewhere and moved in, files renamed into place
+        self.touch('kmod-drbd-9.0.26_5.14.0_70.el9-1.x86_64.rpm', os.path.join(self.tmpdir, 'new', 'rhel9'))
+        os.rename(os.path.join(self.tmpdir, 'new', 'rhel9'), os.path.join(self.repo, 'rhel9'))
+        os.rename(os.path.join(self.repo, KMODS[7]),
+                  os.path.join(self.repo, 'rhel8', 'kmod-drbd-9.0.25_4.18.0_180.el8-1.x86_64.rpm'))
+        self.assertCurrent()
+        self.assertTrue(self.watcher.candidates.best('rhel9.0', '5.14.0-70.el9.x86_64'))
+
+        os.rename(os.path.join(self.repo, 'rhel9'), os.path.join(self.tmpdir, 'rhel9'))
+        shutil.rmtree(os.path.join(self.repo, 'rhel7'))
+        self.assertCurrent()
+        self.assertIsNone(self.watcher.candidates.best('rhel9.0', '5.14.0-70.el9.x86_64'))
+
+        # hard linked into the tree (ln, cp -l, rsync --link-dest): created, but never written
+        linked = os.path.join(self.repo, 'rhel8', 'kmod-drbd-9.0.25_4.18.0_305.el8-1.x86_64.rpm')
+        self.touch('kmod-drbd-9.0.25_4.18.0_305.el8-1.x86_64.rpm', self.tmpdir)
+        os.link(os.path.join(self.tmpdir, 'kmod-drbd-9.0.25_4.18.0_305.el8-1.x86_64.rpm'), linked)
+        self.assertCurrent()
+        self.assertEqual(self.watcher.candidates.best('rhel8', '4.18.0-305.el8'), linked)
+
+
+RHEL8_OSRELEASE = 'NAME="Red Hat Enterprise Linux"\nID="rhel"\nID_LIKE="fedora"\nVERSION_ID="8.4"\n'
+DEBIAN_OSRELEASE = 'PRETTY_NAME="Debian GNU/Linux 11 (bullseye)"\nID=debian\nVERSION="11 (bullseye)"\n'
+
+
+def add_tar_file(tf, name, data=None, link=None):
+    info = tarfile.TarInfo(name)
+    if link is not None:
+        info.type = tarfile.SYMTYPE
+        info.linkname = link
+        tf.addfile(info)
+    else:
+        if not isinstance(data, bytes):
+            data = data.encode()
+        info.size = len(data)
+        tf.addfile(info, io.BytesIO(data))
+
+
+class TestRepoMetadata(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_repodata(self):
+        import gzip
+        repodata = os.path.join(self.tmpdir, 'repodata')
+        os.makedirs(repodata)
+        packages = ''
+        for k in KMODS:
+            name = os.path.basename(k).split('-9.')[0]
+            packages += ('<package type="rpm"><name>{0}</name><arch>x86_64</arch>'
+                         '<location href="{1}"/><format><rpm:provides/></format></package>').format(name, k)
+        primary = ('<?xml version="1.0" encoding="UTF-8"?>\n<metadata xmlns="http://linux.duke.edu/metadata/common" '
+                   'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="{0}">{1}</metadata>').format(
+                       len(KMODS), packages)
+        with gzip.open(os.path.join(repodata, 'abc123-primary.xml.gz'), 'wb') as f:
+            f.write(primary.encode())
+        with open(os.path.join(repodata, 'repomd.xml'), 'w') as f:
+            f.write('<repomd xmlns="http://linux.duke.edu/metadata/repo"><data type="primary">'
+                    '<location href="repodata/abc123-primary.xml.gz"/></data></repomd>')
+
+        self.assertEqual(list(repo_kmods(self.tmpdir)), KMODS[:-1])
+
+    @unittest.skipIf(sys.version_info < (3, 3), 'lzma')
+    def test_packages(self):
+        import lzma
+        stanzas = []
+        for k in KMODS:
+            name = os.path.basename(k).split('-9.')[0]
+            stanzas.append('Package: {0}\nVersion: 9.0\nDescription: x\n y\nFilename: {1}\n'.format(name, k))
+        path = os.path.join(self.tmpdir, 'Packages.xz')
+        with lzma.open(path, 'wb') as f:
+            f.write('\n'.join(stanzas).encode())
+        kmods = list(repo_kmods(path))
+        self.assertEqual(kmods, KMODS[:-1])
+        self.assertEqual(LinbitDistribution.best_drbd_kmod(kmods, name='rhel8.2', hostkernel='4.18.0-180.el8'),
+                         'rhel8/kmod-drbd-9.0.25_4.18.0_147.el8-1.x86_64.rpm')
+
+
+class TestImages(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def layer(self, files):
+        buf = io.BytesIO()
+        tf = tarfile.open(fileobj=buf, mode='w:gz')
+        for name, data, link in files:
+            add_tar_file(tf, name, data, link)
+        tf.close()
+        return buf.getvalue()
+
+    def test_rootfs_dir(self):
+        root = os.path.join(self.tmpdir, 'root')
+        os.makedirs(os.path.join(root, 'etc'))
+        os.makedirs(os.path.join(root, 'usr', 'lib'))
+        with open(os.path.join(root, 'usr', 'lib', 'os-release'), 'w') as f:
+            f.write(RHEL8_OSRELEASE)
+        os.symlink('/usr/lib/os-release', os.path.join(root, 'etc', 'os-release'))
+        d = LinbitDistribution(root=root)
+        self.assertEqual((d.repo_name, d.name, d.version, d.family), ('rhel8.4', 'rhel', '8.4', 'rhel'))
+
+    def test_rootfs_tar(self):
+        path = os.path.join(self.tmpdir, 'rootfs.tar')
+        tf = tarfile.open(path, 'w')
+        add_tar_file(tf, './etc/os-release', link='../usr/lib/os-release')
+        add_tar_file(tf, './usr/lib/os-release', DEBIAN_OSRELEASE)
+        tf.close()
+        d = detect_image(path)
+        self.assertEqual((d.repo_name, d.family), ('bullseye', 'debian'))
+
+    def test_docker_save(self):
+        path = os.path.join(self.tmpdir, 'image.tar')
+        layers = [self.layer([('etc/os-release', DEBIAN_OSRELEASE, None)]),
+                  self.layer([('etc/.wh.os-release', '', None),
+                              ('usr/lib/os-release', RHEL8_OSRELEASE, None),
+                              ('etc/os-release', None, '/usr/lib/os-release')])]
+        tf = tarfile.open(path, 'w')
+        for i, layer in enumerate(layers):
+            add_tar_file(tf, '{0}/layer.tar'.format(i), layer)
+        add_tar_file(tf, 'manifest.json', json.dumps([{'Layers': ['0/layer.tar', '1/layer.tar']}]))
+        tf.close()
+
+        broken = os.path.join(self.tmpdir, 'broken.tar')
+        open(broken, 'w').close()
+        results = list(detect_images([path, broken], jobs=2))
+        self.assertEqual(results[0], (path, ('rhel8.4', 'rhel', '8.4', 'rhel'), None))
+        self.assertEqual(results[1][0], broken)
+        self.assertIsNotNone(results[1][2])
+
+    def test_proxmox_tar(self):
+        # only the pve-manager entry of the dpkg database is kept
+        status = b''.join('Package: pkg{0}\nStatus: install ok installed\nVersion: 1.{0}\n\n'.format(i).encode()
+                          for i in range(1000))
+        status += b'Package: pve-manager\nStatus: install ok installed\nVersion: 7.2-5\n\nPackage: zlib1g\n'
+        path = os.path.join(self.tmpdir, 'rootfs.tar')
+        tf = tarfile.open(path, 'w')
+        add_tar_file(tf, 'etc/os-release', DEBIAN_OSRELEASE)
+        add_tar_file(tf, 'usr/bin/pveversion', '#!/bin/sh\n')
+        add_tar_file(tf, 'var/lib/dpkg/status', status)
+        tf.close()
+        files = read_image_files(path)
+        self.assertEqual(files['var/lib/dpkg/status'],
+                         ('file', b'Package: pve-manager\nStatus: install ok installed\nVersion: 7.2-5\n\n'))
+        d = detect_image(path)
+        self.assertEqual((d.name, d.version, d.repo_name), ('proxmox', '7.2', 'proxmox-7'))
+
+
+class TestLazy(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, 'etc'))
+        os.makedirs(os.path.join(self.tmpdir, 'usr', 'bin'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_family_only(self):
+        with open(os.path.join(self.tmpdir, 'etc', 'centos-release'), 'w') as f:
+            f.write('CentOS release 6.10 (Final)\n')
+        d = LinbitDistribution(root=self.tmpdir)
+        self.assertEqual(d.family, 'rhel')
+        self.assertEqual(d.work['family'], {'stat': 0, 'read': 0, 'exec': 0})
+        self.assertNotIn('version', d.work)
+        self.assertEqual(d.repo_name, 'rhel6.10')
+        self.assertEqual(d.work['version'], {'stat': 0, 'read': 1, 'exec': 0})
+
+    def test_version_errors_on_access(self):
+        # proxmox needs pveversion, which can not be used for a root file system
+        open(os.path.join(self.tmpdir, 'usr', 'bin', 'pveversion'), 'w').close()
+        d = LinbitDistribution(root=self.tmpdir)
+        self.assertEqual((d.name, d.family), ('proxmox', 'debian'))
+        self.assertRaises(Exception, lambda: d.version)
+
+    def test_proxmox_dpkg(self):
+        open(os.path.join(self.tmpdir, 'usr', 'bin', 'pveversion'), 'w').close()
+        os.makedirs(os.path.join(self.tmpdir, 'var', 'lib', 'dpkg'))
+        with open(os.path.join(self.tmpdir, 'var', 'lib', 'dpkg', 'status'), 'wb') as f:
+            f.write(b'Package: pve-manager\nStatus: deinstall ok config-files\nVersion: 6.4-1\n\n'
+                    b'Package: pve-docs\nStatus: install ok installed\nDescription: \xe2\x80\x93\n\n'
+                    b'Package: pve-manager\nStatus: install ok installed\nVersion: 7.2-5\n')
+        d = LinbitDistribution(root=self.tmpdir)
+        self.assertEqual((d.name, d.version, d.repo_name), ('proxmox', '7.2', 'proxmox-7'))
+        self.assertEqual(d.work['version'], {'stat': 0, 'read': 1, 'exec': 0})
+
+
+class TestTracer(unittest.TestCase):
+    def test_phases(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'etc'))
+            with open(os.path.join(tmpdir, 'etc', 'os-release'), 'w') as f:
+                f.write(DEBIAN_OSRELEASE.replace('VERSION=', 'XVERSION='))
+            phases = []
+            d = LinbitDistribution(root=tmpdir, tracer=lambda *args: phases.append(args))
+            self.assertEqual([p[0] for p in phases], ['osrelease'])
+            self.assertRaises(Exception, lambda: d.version)
+            self.assertEqual(phases[-1][0], 'version')
+            self.assertTrue(isinstance(phases[-1][2], Exception))
+            self.assertTrue(phases[0][1] >= 0 and phases[0][2] is None)
+
+            del phases[:]
+            d.epilogue(cachedir=False)
+            self.assertEqual([p[0] for p in phases if p[2] is None],
+                             ['uname', 'family', 'best_module_start', 'install_tool', 'oned', 'best_module'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestRepoNames(unittest.TestCase):
+    def test_bulk(self):
+        records = [('rhel', '8.6', None), ('amzn', '2', None),
+                   {'ID': 'ubuntu', 'VERSION_ID': '22.04', 'VERSION_CODENAME': 'jammy'},
+                   ('sles', '15.4', None), ('xenenterprise', '8.2.1', None), ('proxmox', '7.2', None),
+                   ('rhcos', '4.3', '8.4'), ('rhcos', '4.10', '8.4'), ('rhcos', '4.10', None),
+                   ('rhel', '8.6', None), {'ID': 'debian', 'VERSION_ID': '11', 'VERSION': '11 (bullseye)'},
+                   {'ID': 'rhcos', 'VERSION_ID': '4.10', 'RHEL_VERSION': '8.4'}]
+        self.assertEqual(list(LinbitDistribution.repo_names(records)),
+                         ['rhel8.6', 'amazonlinux2.0', 'jammy', 'sles15-sp4', 'xenserver8', 'proxmox-7',
+                          'rhel8.1', 'rhel8.4', 'rhel8.6', 'rhel8.6', 'bullseye', 'rhel8.4'])
+
+    def test_unknown(self):
+        self.assertRaises(Exception, list, LinbitDistribution.repo_names([('fedora', '38', None)]))
+
+    def test_not_from_version_id(self):
+        # the repos are named after the code name or the CentOS minor release
+        for record in (('debian', '11', None), ('ubuntu', '22.04', None), ('centos', '7', None),
+                       {'ID': 'ubuntu', 'VERSION_ID': '22.04'}, {'ID': 'centos', 'VERSION_ID': '7'},
+                       {'ID': 'debian', 'VERSION_CODENAME': 'trixie'}):
+            self.assertRaises(Exception, list, LinbitDistribution.repo_names([record]))
+
+
+class TestInventory(unittest.TestCase):
+    def test_fleet(self):
+        states = [('rhel8.6', 'rhel', '8.6', 'rhel'), ('rhel9.2', 'almalinux', '9.2', 'rhel'),
+                  ('sles15-sp4', 'sles', '15.4', 'sles'), ('jammy', 'ubuntu', 'jammy', 'debian')]
+        dists = []
+        for repo, name, version, family in states:
+            d = LinbitDistribution._from_state({'osrelease': {'ID': name, 'PRETTY_NAME': 'x' * 40},
+                                                'name': name, 'version': version, 'family': family})
+            self.assertEqual(d.repo_name, repo)
+            dists.append(d)
+
+        n = 100000
+        inv = Inventory()
+        for i in range(n):
+            inv.add(dists[i % 7 % 4], 'node{0}'.format(i))
+        self.assertEqual(len(inv), n)
+        self.assertEqual(inv.count_by('family'), {'rhel': 57143, 'sles': 28571, 'debian': 14286})
+        self.assertEqual(inv.count_by('repo_name', family='rhel'), {'rhel8.6': 28572, 'rhel9.2': 28571})
+        self.assertEqual(inv.count_by('name', 'version', family='sles'), {('sles', '15.4'): 28571})
+        self.assertEqual(inv.count_by('family', version='7'), {})
+        self.assertEqual(inv.group_by('name', repo_name='sles15-sp4')['sles'][:2], ['node2', 'node6'])
+        self.assertEqual(next(iter(inv)), ('node0', 'rhel8.6', 'rhel', '8.6', 'rhel'))
+
+        # the node ids take the most, the columns only a few bytes per node
+        ids = sys.getsizeof([]) + sum(sys.getsizeof('node{0}'.format(i)) + 8 for i in range(n))
+        self.assertLess(inv.memory() - ids, n * 4 * 3)
+
+    def test_undetectable(self):
+        inv = Inventory()
+        inv.add_values(['rhel8.6', 'rhel', '8.6', 'rhel'])
+        inv.add(Distribution._from_state({'osrelease': {'ID': 'rhel'}, 'name': 'rhel', 'version': '8.6',
+                                          'family': 'rhel'}))
+        self.assertEqual(inv.count_by('repo_name'), {'rhel8.6': 1, None: 1})
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+        self.osrelease = os.path.join(self.tmpdir, 'os-release')
+        with open(self.osrelease, 'w') as f:
+            f.write(RHEL8_OSRELEASE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def detect(self):
+        d = cached_distribution(self.osrelease, cachedir=self.cachedir)
+        return d, (d.repo_name, d.name, d.version, d.family)
+
+    def test_hit(self):
+        d, first = self.detect()
+        self.assertIn('osrelease', d.work)
+        d, second = self.detect()
+        self.assertEqual(first, second)
+        self.assertEqual(d.work, {})  # nothing detected
+        self.assertEqual(d.osrelease['VERSION_ID'], '8.4')
+
+    def test_invalidate(self):
+        self.detect()
+        with open(self.osrelease, 'w') as f:
+            f.write(RHEL8_OSRELEASE.replace('8.4', '8.10'))
+        os.utime(self.osrelease, (0, 0))
+        d, v = self.detect()
+        self.assertEqual(v, ('rhel8.10', 'rhel', '8.10', 'rhel'))
+
+    def test_flush(self):
+        self.detect()
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+        flush_cache(self.cachedir)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_private(self):
+        self.detect()
+        self.assertEqual(os.stat(self.cachedir).st_mode & 0o777, 0o700)
+
+        # neither through a symlink nor in a directory others can access
+        target = os.path.join(self.tmpdir, 'target')
+        os.mkdir(target, 0o700)
+        os.symlink(target, os.path.join(self.tmpdir, 'link'))
+        self.cachedir = os.path.join(self.tmpdir, 'link')
+        d, v = self.detect()
+        self.assertEqual(v, ('rhel8.4', 'rhel', '8.4', 'rhel'))
+        self.assertEqual(os.listdir(target), [])
+
+        os.chmod(target, 0o755)
+        self.cachedir = target
+        self.detect()
+        self.assertEqual(os.listdir(target), [])
+
+
+class BestModuleServer(object):
+    # local stand-in for the best module API
+    def __init__(self, answer='kmod-drbd-9.1.0_4.18.0_305-1.x86_64.rpm', delay=0):
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+
+        server = self
+        self.requests = []
+        self.connections = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                server.connections += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                server.requests.append((self.path, body))
+                time.sleep(delay)
+                if answer is None:
+                    self.send_error(404)
+                    return
+                data = answer if isinstance(answer, bytes) else answer.encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}/api/v1/best/'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def unused_url():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'http://127.0.0.1:{0}/api/v1/best/'.format(port)
+
+
+class TestBestModule(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = BestModuleServer()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached(self):
+        for _ in range(2):
+            best = fetch_best_module('4.18.0-305.el8.x86_64', RHEL8_OSRELEASE, self.server.url, cachedir=self.tmpdir)
+            self.assertEqual(best, 'kmod-drbd-9.1.0_4.18.0_305-1.x86_64')
+        self.assertEqual(self.server.requests, [('/api/v1/best/4.18.0-305.el8.x86_64', RHEL8_OSRELEASE.encode())])
+
+        # other kernel, other os-release: other answers
+        fetch_best_module('4.18.0-306.el8.x86_64', RHEL8_OSRELEASE, self.server.url, cachedir=self.tmpdir)
+        fetch_best_module('4.18.0-305.el8.x86_64', DEBIAN_OSRELEASE, self.server.url, cachedir=self.tmpdir)
+        self.assertEqual(len(self.server.requests), 3)
+
+        # opt-in only
+        fetch_best_module('4.18.0-305.el8.x86_64', RHEL8_OSRELEASE, self.server.url)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_cache_entries(self):
+        kernel = '4.18.0-305.el8.x86_64'
+        fetch_best_module(kernel, RHEL8_OSRELEASE, self.server.url, cachedir=self.tmpdir)
+        path, = [os.path.join(self.tmpdir, f) for f in os.listdir(self.tmpdir)]
+        for entry in ({'best': 'kmod-drbd-9.1.0_4.18.0_305-1.x86_64', 'time': time.time() + 3600},
+                      {'best': 'kmod-drbd; rm -rf /', 'time': time.time()}):
+            with open(path, 'w') as f:
+                json.dump(entry, f)
+            best = fetch_best_module(kernel, RHEL8_OSRELEASE, self.server.url, cachedir=self.tmpdir)
+            self.assertEqual(best, 'kmod-drbd-9.1.0_4.18.0_305-1.x86_64')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_bad_answer(self):
+        self.server.close()
+        self.server = BestModuleServer(answer='kmod-drbd $(reboot).rpm')
+        self.assertIsNone(fetch_best_module('4.18.0', RHEL8_OSRELEASE, self.server.url))
+
+    def test_unreachable(self):
+        url = unused_url()
+        self.assertIsNone(fetch_best_module('4.18.0', RHEL8_OSRELEASE, url, cachedir=self.tmpdir))
+        self.assertTrue([f for f in os.listdir(self.tmpdir) if f.startswith('unreachable-')])
+
+    def test_epilogue(self):
+        osrelease = os.path.join(self.tmpdir, 'os-release')
+        with open(osrelease, 'w') as f:
+            f.write(RHEL8_OSRELEASE)
+        d = LinbitDistribution(osrelease)
+        d._best_module_url = self.server.url
+        self.assertIn(' kmod-drbd-9.1.0_4.18.0_305-1.x86_64\n', d.epilogue(cachedir=False))
+        d._best_module_url = unused_url()
+        self.assertIn('drbd-utils drbd-udev kmod-drbd\n', d.epilogue(cachedir=False))
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'asyncio.run')
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        self.server = BestModuleServer(delay=0.05)
+
+    def tearDown(self):
+        self.server.close()
+
+    def hosts(self, n):
+        hosts = []
+        for i in range(n):
+            hosts.append({'osrelease': RHEL8_OSRELEASE, 'kernel': '4.18.0-{0}.el8.x86_64'.format(i % 10),
+                          'executables': ['dnf', 'yum']})
+        hosts.append({'osrelease': DEBIAN_OSRELEASE, 'kernel': '5.10.0-18-amd64', 'executables': ['apt']})
+        hosts.append({'osrelease': 'ID=plan9\n', 'kernel': '1'})
+        return hosts
+
+    def test_epilogues(self):
+        import asyncio
+        from lbdist.fleet import fleet_epilogues
+        results = asyncio.run(fleet_epilogues(self.hosts(40), self.server.url, concurrency=4))
+        self.assertEqual(len(results), 42)
+        self.assertIn('dnf install drbd-utils drbd-udev kmod-drbd-9.1.0_4.18.0_305-1.x86_64\n', results[0][0])
+        self.assertIn('apt install drbd-utils drbd-module-5.10.0-18-amd64 # or drbd-dkms\n', results[40][0])
+        self.assertEqual(results[41], (None, 'Could not determine distribution info'))
+
+        # same text as epilogue() on the host itself
+        d = LinbitDistribution._from_state({'osrelease': {'ID': 'rhel'}, 'name': 'rhel', 'version': '8.4',
+                                            'family': 'rhel'})
+        text = d._epilogue_text('dnf install', False, 'kmod-drbd-9.1.0_4.18.0_305-1.x86_64')
+        self.assertEqual(results[0][0], text)
+
+        # one request per distinct kernel, over at most 4 kept alive connections
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertLessEqual(self.server.connections, 4)
+
+    def test_deadline(self):
+        import asyncio
+        from lbdist.fleet import fleet_epilogues
+        results = asyncio.run(fleet_epilogues(self.hosts(2), self.server.url, timeout=0.01))
+        self.assertIn('dnf install drbd-utils drbd-udev kmod-drbd\n', results[0][0])
+        results = asyncio.run(fleet_epilogues(self.hosts(2), unused_url()))
+        self.assertIn('dnf install drbd-utils drbd-udev kmod-drbd\n', results[1][0])
+
+    def test_bad_answer(self):
+        import asyncio
+        from lbdist.fleet import fleet_epilogues
+        for answer in ('kmod-drbd $(reboot).rpm', b'kmod-drbd-\xff.rpm'):
+            self.server.close()
+            self.server = BestModuleServer(answer=answer)
+            results = asyncio.run(fleet_epilogues(self.hosts(1), self.server.url))
+            self.assertIn('dnf install drbd-utils drbd-udev kmod-drbd\n', results[0][0])
+            self.assertEqual(len(self.server.requests), 1)
+
+
+class TestHostProbe(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dirs = []
+        for i in range(3):
+            d = os.path.join(self.tmpdir, 'bin{0}'.format(i))
+            os.makedirs(d)
+            self.dirs.append(d)
+        self.make(self.dirs[1], 'dnf', 0o755)
+        self.make(self.dirs[0], 'yum', 0o644)
+        self.make(self.dirs[2], 'yum', 0o755)
+        os.symlink('/nonexistent', os.path.join(self.dirs[0], 'dangling'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make(self, d, name, mode):
+        p = os.path.join(d, name)
+        open(p, 'w').close()
+        os.chmod(p, mode)
+
+    def test_path(self):
+        probe = HostProbe(os.path.pathsep.join(self.dirs))
+        for exe in ('apt', 'apt-get', 'zypper'):
+            self.assertFalse(probe.is_in_path(exe))
+        self.assertTrue(probe.is_in_path('dnf'))
+        self.assertTrue(probe.is_in_path('yum'))
+        self.assertEqual((probe.listings, probe.checks), (3, 3))  # access() for dnf and yum twice
+        self.assertEqual(probe.saved_checks, 3 * 3 + 1 + 1)  # a stat() per directory that does not have it
+        self.assertTrue(probe.seconds > 0)
+        self.assertFalse(HostProbe('').is_in_path('dnf'))
+
+    def test_large(self):
+        # too large to be listed, checked per file instead
+        probe = HostProbe(os.path.pathsep.join(self.dirs), max_listing=0)
+        self.assertFalse(probe.is_in_path('apt'))
+        self.assertTrue(probe.is_in_path('dnf'))
+        self.assertTrue(probe.is_in_path('yum'))
+        self.assertEqual((probe.listings, probe.checks), (3, 3 + 3 + 5))  # stat() per directory, access()
+
+    def test_exists(self):
+        probe = HostProbe('')
+        self.assertTrue(probe.exists(os.path.join(self.dirs[1], 'dnf')))
+        self.assertFalse(probe.exists(os.path.join(self.dirs[1], 'yum')))
+        self.assertFalse(probe.exists(os.path.join(self.dirs[0], 'dangling')))
+        self.assertFalse(probe.exists(os.path.join(self.tmpdir, 'nonexistent', 'file')))
+        self.assertEqual((probe.listings, probe.checks), (0, 4))  # single files are not worth a listing
+
+    def test_distribution(self):
+        os.makedirs(os.path.join(self.tmpdir, 'etc'))
+        with open(os.path.join(self.tmpdir, 'etc', 'os-release'), 'w') as f:
+            f.write(RHEL8_OSRELEASE)
+        probe = HostProbe('')
+        d = LinbitDistribution(root=self.tmpdir, probe=probe)
+        self.assertEqual(d.repo_name, 'rhel8.4')
+        self.assertEqual((probe.listings, probe.checks), (0, 2))  # usr/bin/pveversion and etc/os-release
+
+        # shared with epilogue: pveversion is answered from the PATH listing
+        os.makedirs(os.path.join(self.tmpdir, 'usr', 'bin'))
+        probe = HostProbe(os.path.join(self.tmpdir, 'usr', 'bin'))
+        probe.scan()
+        d = LinbitDistribution(root=self.tmpdir, probe=probe)
+        self.assertEqual(d.repo_name, 'rhel8.4')
+        self.assertEqual((probe.listings, probe.checks, probe.saved_checks), (1, 1, 1))
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.osrelease = os.path.join(self.tmpdir, 'os-release')
+        with open(self.osrelease, 'w') as f:
+            f.write(RHEL8_OSRELEASE)
+        self.socket = os.path.join(self.tmpdir, 'lbdist.sock')
+        self.lbdistd = Lbdistd()
+        self.server = make_server(self.socket, self.lbdistd)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def ask(self, **req):
+        req.setdefault('osrelease', self.osrelease)
+        return ask(self.socket, req)
+
+    def test_dist(self):
+        self.assertEqual(self.ask(query='repo_name'), 'rhel8.4')
+        self.assertEqual(self.ask(query='all'), ['rhel8.4', 'rhel', '8.4', 'rhel'])
+        self.assertRaises(ServerError, self.ask, query='nonsense')
+
+    def test_kmod(self):
+        for _ in range(2):
+            best = self.ask(query='kmod', kmods=KMODS, kernel='4.18.0-180.el8.x86_64')
+            self.assertEqual(best, 'rhel8/kmod-drbd-9.0.25_4.18.0_147.el8-1.x86_64.rpm')
+        self.assertEqual(len(self.lbdistd._candidates), 1)  # parsed once
+        self.assertIsNone(self.ask(query='kmod', kmods=KMODS, name='sles15-sp2', kernel='5.3.18-24-default'))
+
+    def test_bounded(self):
+        lbdistd = Lbdistd()
+        for i in range(lbdistd.MAX_CANDIDATES + 5):
+            lbdistd.candidates(kmods=KMODS[:1] * i)
+            osrelease = os.path.join(self.tmpdir, 'os-release-{0}'.format(i))
+            shutil.copy(self.osrelease, osrelease)
+            lbdistd.dist(osrelease)
+        self.assertEqual(len(lbdistd._candidates), lbdistd.MAX_CANDIDATES)
+        self.assertEqual(len(lbdistd._dists), lbdistd.MAX_CANDIDATES + 5)
+        self.assertIs(lbdistd.candidates(kmods=KMODS[:5]), lbdistd.candidates(kmods=KMODS[:5]))
+
+    def test_stale_socket(self):
+        self.assertRaises(socket.error, make_server, self.osrelease)  # not a socket, left alone
+        self.assertTrue(os.path.isfile(self.osrelease))
+        stale = os.path.join(self.tmpdir, 'stale.sock')
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(stale)
+        s.close()
+        make_server(stale).server_close()  # left behind by a previous server, replaced
+
+    def client(self, *args):
+        # lbdisttool.py in tmpdir, with paths relative to it
+        p = subprocess.Popen([sys.executable, os.path.join(TestTool.HERE, 'lbdisttool.py'), '--os-release',
+                              'os-release', '--timings'] + list(args),
+                             cwd=self.tmpdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return out.decode(), err.decode()
+
+    def test_relative_paths(self):
+        out, err = self.client('--socket', self.socket, '-l')
+        self.assertEqual(out, 'rhel8.4\n')
+        self.assertIn('server: ', err)
+        self.assertNotIn('osrelease:', err)  # answered by the server
+
+    def test_watched_dir(self):
+        for k in KMODS:
+            p = os.path.join(self.tmpdir, 'repo', k)
+            if not os.path.isdir(os.path.dirname(p)):
+                os.makedirs(os.path.dirname(p))
+            open(p, 'w').close()
+        sock = os.path.join(self.tmpdir, 'watched.sock')
+        server = subprocess.Popen([sys.executable, os.path.join(TestTool.HERE, 'lbdisttool.py'), '--serve', sock,
+                                   '--kmods-dir', 'repo', '--watch'], cwd=self.tmpdir)
+        try:
+            deadline = time.time() + 10
+            while not os.path.exists(sock) and time.time() < deadline:
+                time.sleep(0.05)
+            query = ('--socket', sock, '--kmods-dir', 'repo', '--force-kernel-release', '4.18.0-180.el8.x86_64')
+            out, err = self.client(*query)
+            self.assertEqual(out, 'repo/rhel8/kmod-drbd-9.0.25_4.18.0_147.el8-1.x86_64.rpm\n')
+            self.assertIn('server: ', err)
+            self.assertNotIn('failed', err)
+
+            # published while the server runs, it picks it up in the background
+            open(os.path.join(self.tmpdir, 'repo', 'rhel8', 'kmod-drbd-9.0.25_4.18.0_180.el8-1.x86_64.rpm'),
+                 'w').close()
+            while True:
+                out, err = self.client(*query)
+                if 'repo/rhel8/kmod-drbd-9.0.25_4.18.0_180.el8-1.x86_64.rpm\n' == out or time.time() > deadline:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(out, 'repo/rhel8/kmod-drbd-9.0.25_4.18.0_180.el8-1.x86_64.rpm\n')
+            self.assertNotIn('failed', err)
+        finally:
+            server.terminate()
+            server.wait()
+
+    def test_republished_index(self):
+        index = os.path.join(self.tmpdir, 'kmods.idx')
+        write_kmod_index(KMODS[:2], index)
+        kernel = '4.18.0-180.el8.x86_64'
+        self.assertEqual(self.ask(query='kmod', kmods=[index], kernel=kernel), KMODS[1])
+        write_kmod_index(KMODS[:3], index)
+        self.assertEqual(self.ask(query='kmod', kmods=[index], kernel=kernel), KMODS[2])
+
+
+class TestTool(unittest.TestCase):
+    HERE = os.path.dirname(os.path.abspath(__file__))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.osrelease = os.path.join(self.tmpdir, 'os-release')
+        with open(self.osrelease, 'w') as f:
+            f.write(RHEL8_OSRELEASE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def tool(self, *args):
+        p = subprocess.Popen([sys.executable, os.path.join(self.HERE, 'lbdisttool.py'), '--os-release',
+                              self.osrelease, '--timings'] + list(args),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return p.returncode, out.decode(), err.decode()
+
+    def batch(self, osrelease, queries):
+        p = subprocess.Popen([sys.executable, os.path.join(self.HERE, 'lbdisttool.py'), '--os-release', osrelease,
+                              '--batch', '-k'] + KMODS, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, _ = p.communicate('\n'.join(json.dumps(q) for q in queries).encode())
+        self.assertEqual(p.returncode, 0)
+        return [json.loads(line) for line in out.decode().splitlines()]
+
+    def test_batch(self):
+        kernel = '4.18.0-180.el8.x86_64'
+        queries = [{'kernel': kernel}, {'name': ['rhel8'], 'kernel': kernel}, {'name': 'rhel8', 'kernel': 4}, [kernel]]
+        results = self.batch(self.osrelease, queries)
+        self.assertEqual(results[0]['kmod'], 'rhel8/kmod-drbd-9.0.25_4.18.0_147.el8-1.x86_64.rpm')
+        self.assertEqual([r.get('error') for r in results[1:]], [
+            'invalid query: "name" is not a string',
+            'invalid query: "kernel" is not a string',
+            'invalid query: not a JSON object'])
+
+        # detection fails per query, queries with a name still work
+        queries = [{'kernel': kernel}, {'name': 'rhel8', 'kernel': kernel}]
+        results = self.batch(os.path.join(self.tmpdir, 'nonexistent'), queries)
+        self.assertIn('error', results[0])
+        self.assertNotIn('kmod', results[0])
+        self.assertEqual(results[1]['kmod'], 'rhel8/kmod-drbd-9.0.25_4.18.0_147.el8-1.x86_64.rpm')
+
+    def test_combined_epilogue(self):
+        # the epilogue spans lines, only json keeps it apart from other fields
+        rc, out, err = self.tool('-l', '-e')
+        self.assertEqual((rc, out), (2, ''))
+        self.assertIn('--format json', err)
+
+        debian = os.path.join(self.tmpdir, 'debian-os-release')  # no best module lookup
+        with open(debian, 'w') as f:
+            f.write(DEBIAN_OSRELEASE)
+        rc, out, err = self.tool('--os-release', debian, '-l', '-e', '--format', 'json')
+        self.assertEqual(rc, 0)
+        self.assertIn('saved checks', err)  # detection and epilogue shared one probe
+        v = json.loads(out)
+        self.assertEqual(v['repo_name'], 'bullseye')
+        self.assertIn('drbd-utils', v['epilogue'])
+
+    def test_combined(self):
+        kmod = 'kmod-drbd-9.1.0_4.18.0_305.el8-1.x86_64.rpm'
+        rc, out, err = self.tool('-f', '-n', '-k', kmod, '--force-kernel-release', '4.18.0-305.el8.x86_64')
+        self.assertEqual((rc, out), (0, 'rhel,rhel,{0}\n'.format(kmod)))
+        self.assertEqual(err.count('osrelease:'), 1)  # one detection pass
+
+        rc, out, _ = self.tool('-a', '-k', kmod, '--force-kernel-release', '5.14.0', '--format', 'json')
+        self.assertEqual(rc, 1)
+        self.assertEqual(json.loads(out), {'repo_name': 'rhel8.4', 'name': 'rhel', 'version': '8.4',
+                                           'family': 'rhel', 'kmod': None})
+
+        self.assertEqual(self.tool('-l')[:2], (0, 'rhel8.4\n'))
+        self.assertEqual(self.tool('-k', kmod, '--force-kernel-release', '5.14.0')[:2], (1, ''))
+
+
+class TestBench(unittest.TestCase):
+    RESULTS = [{'name': 'detect', 'dist': 'rhel', 'seconds': 0.000004, 'runs': 5888},
+               {'name': 'kmod_index_write', 'candidates': 1000, 'seconds': 0.01, 'runs': 35}]
+
+    def test_compare(self):
+        import bench
+        baseline = {'results': self.RESULTS}
+        self.assertEqual(bench.compare(self.RESULTS, baseline, 0.5, 0.00001), [])
+
+        slower = [dict(r, seconds=r['seconds'] * 2) for r in self.RESULTS]
+        self.assertEqual(bench.compare(slower, baseline, 0.5, 0.00001), [(slower[1], 0.01)])  # detect: noise
+
+    def test_fastest(self):
+        import bench
+        second = [dict(self.RESULTS[0], seconds=0.000003), dict(self.RESULTS[1], seconds=0.02)]
+        self.assertEqual(bench.fastest(self.RESULTS, second), [second[0], self.RESULTS[1]])
+
+
+class TestImports(unittest.TestCase):
+    # startup cost regression: the common queries must not pull in the heavy modules
+    HEAVY = ('subprocess', 'platform', 'json', 'socket', 'threading', 'tarfile', 'multiprocessing', 'mmap',
+             'urllib.request', 'urllib2', 'hashlib')
+    HERE = os.path.dirname(os.path.abspath(__file__))
+
+    def loaded(self, code):
+        out = subprocess.check_output([sys.executable, '-S', '-c', code + '\nprint(" ".join(sys.modules))'],
+                                      cwd=self.HERE)
+        return set(out.decode().split())
+
+    def added(self, code, baseline):
+        # what code loads on top of baseline, the interpreter and the stdlib alone pull in different modules
+        # depending on the Python version (e.g., argparse imports threading via gettext on 3.8)
+        return self.loaded(code) - self.loaded(baseline)
+
+    def test_library(self):
+        loaded = self.added('import sys, lbdist', 'import sys')
+        self.assertEqual(loaded & set(self.HEAVY + ('re', 'functools')), set())
+
+    def test_cli(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            osrelease = os.path.join(tmpdir, 'os-release')
+            with open(osrelease, 'w') as f:
+                f.write(RHEL8_OSRELEASE)
+            loaded = self.added('import runpy, sys\nsys.argv = ["lbdisttool.py", "--os-release", {0!r}, "-l"]\n'
+                                'runpy.run_path("lbdisttool.py", run_name="__main__")'.format(osrelease),
+                                'import runpy, sys, argparse')
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertIn('lbdist.distribution', loaded)
+        self.assertEqual(loaded & set(self.HEAVY), set())
+
 
 if __name__ == '__main__':
     unittest.main()